@@ -0,0 +1,154 @@
+import os, sys
+import argparse
+import tempfile
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import cbioportal_merge
+import common.inventory as inventory
+from common.lazy_import import LazyModule
+
+parse_cache = LazyModule("common.parse_cache")
+
+# Merges every study listed in a YAML or JSON manifest in one process. Studies share the
+# thread pools and the parse cache, and the clinical and CNA files they have in common are
+# parsed once and kept in memory for all of them (see common/parse_cache.py).
+#
+# The manifest holds a list of studies, each given with the options of cbioportal_merge.py
+# (desc and title are accepted for project_desc and project_title), and optional defaults
+# applied to every study:
+#
+#   defaults:
+#     project_desc: "My project description"
+#   studies:
+#     - study_id: my_study_id
+#       directories: [/path/to/proj1/portal, /path/to/proj2/portal]
+#       project_title: My study
+#
+# --jobs, --cache_dir and --cache_size_mb apply to the whole batch. Profiling records the
+# stages of the whole process, so the studies of a batch cannot be profiled; --profile and
+# --profile_trace are refused in the manifest.
+
+STUDY_KEY_ALIASES = {'desc': 'project_desc', 'title': 'project_title'}
+BATCH_OPTIONS = ['jobs', 'cache_dir', 'cache_size_mb']
+UNSUPPORTED_OPTIONS = ['profile', 'profile_trace']
+
+def load_studies(manifest_file):
+    from ruamel import yaml
+    with open(manifest_file, 'r') as f:
+        data = yaml.safe_load(f)
+    if isinstance(data, list):
+        data = {'studies': data}
+    if not isinstance(data, dict) or not data.get('studies'):
+        print("No studies found in %s" % manifest_file)
+        sys.exit(1)
+    defaults = data.get('defaults') or dict()
+    studies = list()
+    for study in data['studies']:
+        options = dict(defaults)
+        options.update(study)
+        studies.append(options)
+    return studies
+
+# Validates a study's options through the cbioportal_merge.py command line parser
+def get_request_dict(study, output_root):
+    argv = list()
+    for key, value in study.items():
+        key = STUDY_KEY_ALIASES.get(key, key)
+        if key in BATCH_OPTIONS:
+            print("Ignoring %s in study %s; it applies to the whole batch" % (key, study.get('study_id')))
+            continue
+        if key in UNSUPPORTED_OPTIONS:
+            print("%s is not supported in study %s; profile the study with cbioportal_merge.py instead" % (key, study.get('study_id')))
+            sys.exit(1)
+        if value is None or value is False:
+            continue
+        argv.append("--" + key)
+        if isinstance(value, list):
+            argv.extend(str(v) for v in value)
+        elif value is not True:
+            argv.append(str(value))
+    try:
+        request_dict = vars(cbioportal_merge.get_parser().parse_args(argv))
+    except SystemExit:
+        print("Invalid options for study %s" % study.get('study_id'))
+        sys.exit(1)
+    if request_dict['output_directory'] is None:
+        request_dict['output_directory'] = os.path.join(output_root, request_dict['study_id'])
+    return request_dict
+
+# Absolute paths of the input files found in the directories of more than one study
+def get_shared_files(requests):
+    directories = [directory for request_dict in requests for directory in request_dict['directories']]
+    inputs = inventory.scan(directories, cbioportal_merge.INPUT_FILES, cbioportal_merge.INPUT_GLOBS)
+    counts = Counter()
+    for request_dict in requests:
+        paths = set()
+        for directory in request_dict['directories']:
+            paths.update(os.path.abspath(fpath) for fpath in inputs.get_paths(directory).values())
+        counts.update(paths)
+    return [fpath for fpath, count in counts.items() if count > 1]
+
+def merge_timed(request_dict):
+    start = time.perf_counter()
+    result = {'output_directory': request_dict['output_directory']}
+    try:
+        result['report'] = cbioportal_merge.merge_study(request_dict)
+    except (Exception, SystemExit) as e:
+        traceback.print_exc()
+        result['error'] = repr(e)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+def runner(args):
+    studies = load_studies(args.manifest)
+    requests = [get_request_dict(study, args.output_root) for study in studies]
+    output_dirs = [os.path.abspath(request_dict['output_directory']) for request_dict in requests]
+    study_ids = [request_dict['study_id'] for request_dict in requests]
+    if len(set(output_dirs)) != len(output_dirs) or len(set(study_ids)) != len(study_ids):
+        print("Every study in %s needs its own study_id and output_directory" % args.manifest)
+        sys.exit(1)
+
+    for output_dir in output_dirs:
+        os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+    parse_cache.share_in_memory(True, args.cache_size_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory(prefix="aion_cache_") as tmp_cache:
+        # without a --cache_dir, MAF-like and seg files shared by several studies go through a
+        # cache that only lasts for this batch; the files of a single study are not cached
+        cache_dir = args.cache_dir or tmp_cache
+        cbioportal_merge.configure({'jobs': args.jobs, 'cache_dir': cache_dir, 'cache_size_mb': args.cache_size_mb})
+        if not args.cache_dir:
+            parse_cache.cache_only(get_shared_files(requests))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.parallel_studies or args.jobs) as pool:
+            results = list(pool.map(merge_timed, requests))
+        total = time.perf_counter() - start
+        parse_cache.configure(None, 0)
+        parse_cache.cache_only(None)
+    parse_cache.share_in_memory(False, 0)
+
+    report = {'seconds': round(total, 3), 'studies': dict()}
+    for study_id, result in zip(study_ids, results):
+        report['studies'][study_id] = result
+        status = "failed" if 'error' in result else "merged"
+        print("%s %s in %.1fs" % (study_id, status, result['seconds']))
+    print("%i studies in %.1fs" % (len(results), total))
+    if args.report_file:
+        cbioportal_merge.write_report(args.report_file, report)
+    if any('error' in result for result in results):
+        sys.exit(1)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the studies listed in a YAML or JSON manifest in one process")
+    parser.add_argument("--manifest", required=True, help="YAML or JSON file listing the studies to merge")
+    parser.add_argument("--output_root", required=False, default=".", help="Directory under which studies without an output_directory are written, one subdirectory per study_id")
+    parser.add_argument("--jobs", required=False, type=int, default=1, help="Number of merges and input file reads to run concurrently")
+    parser.add_argument("--parallel_studies", required=False, type=int, help="Number of studies merged at once (default: --jobs)")
+    parser.add_argument("--cache_dir", required=False, help="Directory of a parse cache shared between merges; by default a temporary cache is used for the batch")
+    parser.add_argument("--cache_size_mb", required=False, type=int, default=cbioportal_merge.DEFAULT_CACHE_SIZE_MB, help="Size above which the least recently used parse cache entries are evicted")
+    parser.add_argument("--report_file", required=False, help="Write a JSON report with the timing and merge report of every study to this path")
+    args = parser.parse_args()
+    runner(args)
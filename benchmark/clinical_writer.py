@@ -0,0 +1,67 @@
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+import common.clinical_data_merge as clin_data_merge
+
+# Compares the block writer in clinical_data_merge.create_data_rows against the previous
+# row-by-row string concatenation on a synthetic data_clinical_sample.txt frame.
+#
+# Run from the repository root:
+#   python -m benchmark.clinical_writer --samples 500000
+
+ONCOTREE_CODES = ["LUAD", "LUSC", "BRCA", "COAD", "PRAD", "SKCM", "GBM", "PAAD"]
+
+def make_sample_df(num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = np.arange(num_samples)
+    df = pd.DataFrame()
+    df['SAMPLE_ID'] = ["s_C_%06d_T001_d" % i for i in ids]
+    df['PATIENT_ID'] = ["C_%06d" % (i // 2) for i in ids]
+    df['ONCOTREE_CODE'] = rng.choice(ONCOTREE_CODES, num_samples)
+    df['PROJECT_ID'] = rng.choice(["06362", "08390", "09606"], num_samples)
+    df['REQUEST_ID'] = df['PROJECT_ID'] + "_B"
+    df['SAMPLE_CLASS'] = "Tumor"
+    df['TUMOR_PURITY'] = rng.random(num_samples).round(3)
+    df['AGE_AT_SEQUENCING'] = rng.integers(18, 90, num_samples)
+    return df
+
+# create_data_rows as it was before the block writer
+def legacy_create_data_rows(df):
+    s = "\t".join(df.columns.values.tolist()) + "\n"
+    for i in df.values.tolist():
+        s += "\t".join(map(str, i)) + "\n"
+    return s
+
+def run(num_samples, repeat):
+    df = make_sample_df(num_samples)
+    legacy_times = list()
+    block_times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        expected = legacy_create_data_rows(df)
+        legacy_times.append(time.perf_counter() - start)
+
+        out = io.StringIO()
+        start = time.perf_counter()
+        clin_data_merge.create_data_rows(df, out)
+        block_times.append(time.perf_counter() - start)
+        if out.getvalue() != expected:
+            raise AssertionError("create_data_rows output differs from the legacy writer")
+    return {
+        'samples': num_samples,
+        'legacy_seconds': min(legacy_times),
+        'block_seconds': min(block_times),
+        'speedup': min(legacy_times) / min(block_times),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=500000, help="Number of synthetic samples")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions; the best run is reported")
+    args = parser.parse_args()
+    print(json.dumps(run(args.samples, args.repeat), indent=2))
@@ -0,0 +1,53 @@
+import argparse
+import io
+import json
+import time
+
+import pandas as pd
+
+import cbioportal_merge
+import common.clinical_data_merge as clin_data_merge
+import common.dtypes as dtypes
+
+# Times cbioportal_merge.make_derived_case_lists on a synthetic merged sample table and
+# checks that every list holds the SAMPLE_IDs as data_clinical_sample.txt writes them.
+# Half the samples have numeric ids, which the compact dtypes parse as integers.
+
+def make_sample_df(num_samples):
+    df = pd.DataFrame()
+    df['SAMPLE_ID'] = [str(1000 + i) if i % 2 else "s_C_%06d_T001_d" % i for i in range(num_samples)]
+    df['PATIENT_ID'] = ["C_%06d" % (i // 2) for i in range(num_samples)]
+    numeric_df = pd.DataFrame({'SAMPLE_ID': [str(1000 + i) for i in range(num_samples)], 'PATIENT_ID': df['PATIENT_ID']})
+    return [dtypes.apply_clinical_dtypes(df), dtypes.apply_clinical_dtypes(numeric_df)]
+
+def get_written_ids(df):
+    out = io.StringIO()
+    clin_data_merge.create_data_rows(df[['SAMPLE_ID']], out)
+    return out.getvalue().splitlines()[1:]
+
+def get_case_list_ids(text):
+    for line in text.splitlines():
+        if line.startswith("case_list_ids:"):
+            return line.split(":", 1)[1].strip(" ").split("\t")
+    return []
+
+def run(num_samples, repeat):
+    results = list()
+    for df in make_sample_df(num_samples):
+        expected = get_written_ids(df)
+        times = list()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cases = cbioportal_merge.make_derived_case_lists("study", df['SAMPLE_ID'], expected[::2], expected[1::2])
+            times.append(time.perf_counter() - start)
+        if get_case_list_ids(cases[cbioportal_merge.CASE_LISTS_ALL]) != expected:
+            raise AssertionError("cases_all.txt does not list the SAMPLE_IDs as written (dtype %s)" % df['SAMPLE_ID'].dtype)
+        results.append({'sample_id_dtype': str(df['SAMPLE_ID'].dtype), 'seconds': min(times)})
+    return {'samples': num_samples, 'runs': results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=100000, help="Number of synthetic samples")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions; the best run is reported")
+    args = parser.parse_args()
+    print(json.dumps(run(args.samples, args.repeat), indent=2))
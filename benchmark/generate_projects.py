@@ -0,0 +1,204 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import cbioportal_merge
+import common.clinical_definitions as clinical_definitions
+
+# Writes synthetic Argos-style portal directories holding every file runner looks for,
+# plus a sample data clinical file covering all of their samples.
+#
+# Run from the repository root:
+#   python -m benchmark.generate_projects --output /tmp/aion_projects --projects 10 --samples 1000
+
+ONCOTREE_CODES = ["LUAD", "LUSC", "BRCA", "COAD", "PRAD", "SKCM", "GBM", "PAAD"]
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ["X"]
+SAMPLE_COLUMNS = ["SAMPLE_ID", "PATIENT_ID", "COLLAB_ID", "ONCOTREE_CODE", "REQUEST_ID", "PROJECT_ID",
+    "PROJECT_PI", "SAMPLE_CLASS", "SPECIMEN_PRESERVATION_TYPE", "SAMPLE_COVERAGE", "GENE_PANEL"]
+PATIENT_COLUMNS = ["PATIENT_ID", "SEX"]
+MAF_COLUMNS = ["Hugo_Symbol", "Entrez_Gene_Id", "Center", "Tumor_Sample_Barcode", "Chromosome", "Start_Position",
+    "End_Position", "Variant_Classification", "Variant_Type", "Reference_Allele", "Tumor_Seq_Allele1",
+    "Tumor_Seq_Allele2", "HGVSp_Short", "t_depth", "t_alt_count", "n_depth", "n_alt_count"]
+VARIANT_CLASSES = ["Missense_Mutation", "Nonsense_Mutation", "Silent", "Frame_Shift_Del", "Splice_Site"]
+BASES = np.array(["A", "C", "G", "T"])
+SEG_FILE = "%s_data_cna_hg19.seg"
+SEG_META_FILE = "%s_meta_cna_hg19_seg.txt"
+SAMPLE_DATA_CLINICAL_FILE = "sample_data_clinical.txt"
+
+def generate(output_dir, num_projects, num_samples, num_mutations, num_genes, num_seg_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    genes = np.array(["GENE%05d" % i for i in range(num_genes)])
+    directories = list()
+    clinical = list()
+    for p in range(num_projects):
+        project_id = "%05d" % (6000 + p)
+        directory = os.path.join(output_dir, "Proj_%s" % project_id, "portal")
+        os.makedirs(os.path.join(directory, "case_lists"), exist_ok=True)
+        samples = ["s_C_%05d%03d_T001_d" % (p, i) for i in range(num_samples)]
+        patients = ["C_%05d%03d" % (p, i // 2) for i in range(num_samples)]
+        sample_df = make_sample_df(rng, samples, patients, project_id)
+        patient_df = pd.DataFrame({'PATIENT_ID': patients, 'SEX': rng.choice(["Male", "Female"], num_samples)}).drop_duplicates('PATIENT_ID')
+        write_clinical(os.path.join(directory, cbioportal_merge.CLINICAL_DATA_SAMPLE_FILE), sample_df)
+        write_clinical(os.path.join(directory, cbioportal_merge.CLINICAL_DATA_PATIENT_FILE), patient_df)
+        write_meta_study(os.path.join(directory, cbioportal_merge.META_STUDY_FILE), project_id)
+        write_table(os.path.join(directory, cbioportal_merge.DATA_CNA_FILE), make_cna_df(rng, genes, samples, [-2, -1, 0, 0, 0, 1, 2]))
+        write_table(os.path.join(directory, cbioportal_merge.DATA_ASCNA_FILE), make_cna_df(rng, genes, samples, ["Gain", "Loss", "CNLOH", "NA", ""]))
+        mutations = make_maf_df(rng, genes, samples, num_mutations)
+        write_table(os.path.join(directory, cbioportal_merge.DATA_MUTATIONS_FILE), mutations)
+        write_table(os.path.join(directory, cbioportal_merge.DATA_MUTATIONS_UNCALLED_FILE), mutations.sample(frac=0.1, random_state=seed + p))
+        write_table(os.path.join(directory, cbioportal_merge.DATA_FUSION_FILE), make_fusion_df(rng, genes, samples))
+        write_table(os.path.join(directory, cbioportal_merge.DATA_SV_FILE), make_sv_df(rng, genes, samples))
+        write_table(os.path.join(directory, SEG_FILE % project_id), make_seg_df(rng, samples, num_seg_rows))
+        write_seg_meta(os.path.join(directory, SEG_META_FILE % project_id), project_id)
+        for case_list, case_type in [(cbioportal_merge.CASE_LISTS_ALL, "all"), (cbioportal_merge.CASE_LISTS_CNA, "cna"),
+                (cbioportal_merge.CASE_LISTS_CNASEQ, "cnaseq"), (cbioportal_merge.CASE_LISTS_SEQ, "sequenced")]:
+            write_case_list(os.path.join(directory, case_list), project_id, case_type, samples)
+        directories.append(directory)
+        clinical.append(pd.concat([sample_df[['SAMPLE_ID', 'PATIENT_ID', 'ONCOTREE_CODE']], patient_df.set_index('PATIENT_ID')['SEX'].reindex(patients).reset_index(drop=True)], axis=1))
+    sample_data_clinical_file = os.path.join(output_dir, SAMPLE_DATA_CLINICAL_FILE)
+    write_table(sample_data_clinical_file, pd.concat(clinical, ignore_index=True))
+    return directories, sample_data_clinical_file
+
+def make_sample_df(rng, samples, patients, project_id):
+    n = len(samples)
+    df = pd.DataFrame()
+    df['SAMPLE_ID'] = samples
+    df['PATIENT_ID'] = patients
+    df['COLLAB_ID'] = ["COLLAB_%06d" % i for i in rng.integers(0, 10 ** 6, n)]
+    df['ONCOTREE_CODE'] = rng.choice(ONCOTREE_CODES, n)
+    df['REQUEST_ID'] = project_id + "_B"
+    df['PROJECT_ID'] = project_id
+    df['PROJECT_PI'] = "pi@example.org"
+    df['SAMPLE_CLASS'] = "Tumor"
+    df['SPECIMEN_PRESERVATION_TYPE'] = rng.choice(["Frozen", "FFPE"], n)
+    df['SAMPLE_COVERAGE'] = rng.integers(100, 1000, n)
+    df['GENE_PANEL'] = "IMPACT468"
+    return df
+
+def make_cna_df(rng, genes, samples, values):
+    values = np.array(values, dtype=object)
+    df = pd.DataFrame(values[rng.integers(0, len(values), (len(genes), len(samples)))], columns=samples)
+    df.insert(0, 'Hugo_Symbol', genes)
+    return df
+
+def make_maf_df(rng, genes, samples, num_mutations):
+    n = len(samples) * num_mutations
+    start = rng.integers(1, 2 * 10 ** 8, n)
+    df = pd.DataFrame()
+    df['Hugo_Symbol'] = rng.choice(genes, n)
+    df['Entrez_Gene_Id'] = 0
+    df['Center'] = "MSKCC"
+    df['Tumor_Sample_Barcode'] = np.repeat(samples, num_mutations)
+    df['Chromosome'] = rng.choice(CHROMOSOMES, n)
+    df['Start_Position'] = start
+    df['End_Position'] = start
+    df['Variant_Classification'] = rng.choice(VARIANT_CLASSES, n)
+    df['Variant_Type'] = "SNP"
+    df['Reference_Allele'] = rng.choice(BASES, n)
+    df['Tumor_Seq_Allele1'] = df['Reference_Allele']
+    df['Tumor_Seq_Allele2'] = rng.choice(BASES, n)
+    df['HGVSp_Short'] = ["p.X%iY" % i for i in rng.integers(1, 2000, n)]
+    df['t_depth'] = rng.integers(50, 1000, n)
+    df['t_alt_count'] = rng.integers(5, 50, n)
+    df['n_depth'] = rng.integers(50, 500, n)
+    df['n_alt_count'] = 0
+    return df[MAF_COLUMNS]
+
+def make_fusion_df(rng, genes, samples):
+    n = len(samples)
+    df = pd.DataFrame()
+    df['Hugo_Symbol'] = rng.choice(genes, n)
+    df['Entrez_Gene_Id'] = 0
+    df['Center'] = "MSKCC"
+    df['Tumor_Sample_Barcode'] = samples
+    df['Fusion'] = df['Hugo_Symbol'] + "-" + rng.choice(genes, n) + " fusion"
+    df['DNA_support'] = "yes"
+    df['RNA_support'] = "unknown"
+    df['Method'] = "Manta"
+    df['Frame'] = rng.choice(["in frame", "out of frame"], n)
+    return df
+
+def make_sv_df(rng, genes, samples):
+    n = len(samples)
+    df = pd.DataFrame()
+    df['Sample_Id'] = samples
+    df['SV_Status'] = "SOMATIC"
+    df['Site1_Hugo_Symbol'] = rng.choice(genes, n)
+    df['Site1_Chromosome'] = rng.choice(CHROMOSOMES, n)
+    df['Site1_Position'] = rng.integers(1, 2 * 10 ** 8, n)
+    df['Site2_Hugo_Symbol'] = rng.choice(genes, n)
+    df['Site2_Chromosome'] = rng.choice(CHROMOSOMES, n)
+    df['Site2_Position'] = rng.integers(1, 2 * 10 ** 8, n)
+    df['Class'] = rng.choice(["DELETION", "DUPLICATION", "INVERSION", "TRANSLOCATION"], n)
+    return df
+
+def make_seg_df(rng, samples, num_seg_rows):
+    n = len(samples) * num_seg_rows
+    start = rng.integers(1, 2 * 10 ** 8, n)
+    df = pd.DataFrame()
+    df['ID'] = np.repeat(samples, num_seg_rows)
+    df['chrom'] = rng.choice(CHROMOSOMES, n)
+    df['loc.start'] = start
+    df['loc.end'] = start + rng.integers(1000, 10 ** 6, n)
+    df['num.mark'] = rng.integers(10, 1000, n)
+    df['seg.mean'] = rng.normal(0, 0.5, n).round(4)
+    return df
+
+def write_table(fpath, df):
+    df.to_csv(fpath, sep='\t', index=False)
+
+# Clinical files start with the display name, description, datatype and priority rows
+def write_clinical(fpath, df):
+    definitions = clinical_definitions.get_definitions()
+    rows = list()
+    for attr in ['display_name', 'desc', 'datatype', 'priority']:
+        rows.append("#" + "\t".join(str(definitions[col][attr]) for col in df.columns))
+    with open(fpath, 'w') as f:
+        f.write("\n".join(rows) + "\n")
+        df.to_csv(f, sep='\t', index=False)
+
+def write_meta_study(fpath, project_id):
+    with open(fpath, 'w') as f:
+        f.write("type_of_cancer: mixed\n")
+        f.write("cancer_study_identifier: Proj_%s\n" % project_id)
+        f.write("name: Project %s\n" % project_id)
+        f.write("short_name: Proj_%s\n" % project_id)
+        f.write("description: Synthetic project %s\n" % project_id)
+        f.write("groups: PRISM\n")
+
+def write_seg_meta(fpath, project_id):
+    with open(fpath, 'w') as f:
+        f.write("cancer_study_identifier: Proj_%s\n" % project_id)
+        f.write("genetic_alteration_type: COPY_NUMBER_ALTERATION\n")
+        f.write("datatype: SEG\n")
+        f.write("reference_genome_id: hg19\n")
+        f.write("description: Copy number segments\n")
+        f.write("data_filename: %s\n" % (SEG_FILE % project_id))
+
+def write_case_list(fpath, project_id, case_type, samples):
+    with open(fpath, 'w') as f:
+        f.write("cancer_study_identifier: Proj_%s\n" % project_id)
+        f.write("stable_id: Proj_%s_%s\n" % (project_id, case_type))
+        f.write("case_list_name: %s\n" % case_type)
+        f.write("case_list_description: %s samples\n" % case_type)
+        f.write("case_list_category: all_cases_in_study\n")
+        f.write("case_list_ids:\t%s\n" % "\t".join(samples))
+
+def add_scale_arguments(parser):
+    parser.add_argument("--projects", type=int, default=10, help="Number of project directories")
+    parser.add_argument("--samples", type=int, default=200, help="Samples per project")
+    parser.add_argument("--mutations", type=int, default=50, help="Mutations per sample")
+    parser.add_argument("--genes", type=int, default=500, help="Genes in each CNA file")
+    parser.add_argument("--seg_rows", type=int, default=50, help="Seg rows per sample")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", required=True, help="Directory to write the projects to")
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    directories, sample_data_clinical_file = generate(args.output, args.projects, args.samples, args.mutations, args.genes, args.seg_rows, args.seed)
+    print("\n".join(directories))
+    print(sample_data_clinical_file)
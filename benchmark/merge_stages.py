@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import cbioportal_merge
+import common.clinical_data_merge as clin_data_merge
+import common.clinical_meta_merge as clin_meta_merge
+import common.case_lists_merge as case_lists_merge
+import common.seg_merge as seg_merge
+import common.parallel as parallel
+import common.parse_cache as parse_cache
+import benchmark.generate_projects as generate_projects
+
+# Times each stage of runner, and a full runner call, on synthetic projects from
+# benchmark.generate_projects (or on existing project directories), and writes a JSON
+# report that can be compared between versions. Each stage is timed --repeat times and
+# the best run is kept; its peak traced allocation is measured in a separate run under
+# tracemalloc, so tracing does not skew the timings.
+#
+# Run from the repository root:
+#   python -m benchmark.merge_stages --projects 10 --samples 1000 --report_file before.json
+
+STUDY_ID = "benchmark_study"
+
+def get_inputs(directories):
+    inputs = dict()
+    for directory in directories:
+        for fname, fpath in cbioportal_merge.find_input_files(directory).items():
+            inputs.setdefault(fname, list()).append(fpath)
+    return inputs
+
+def stage_clinical(inputs, sample_data_clinical_files, out_dir, state):
+    sample_df, patient_df = clin_data_merge.read_sample_data_clinical(sample_data_clinical_files)
+    with open(os.path.join(out_dir, cbioportal_merge.CLINICAL_DATA_SAMPLE_FILE), 'w') as out:
+        state['clin_sample_df'] = clin_data_merge.run_merge(inputs.get(cbioportal_merge.CLINICAL_DATA_SAMPLE_FILE, []), out, additional_df=sample_df)
+    with open(os.path.join(out_dir, cbioportal_merge.CLINICAL_DATA_PATIENT_FILE), 'w') as out:
+        clin_data_merge.run_merge_patient(inputs.get(cbioportal_merge.CLINICAL_DATA_PATIENT_FILE, []), out, additional_df=patient_df)
+
+def stage_cna(inputs, sample_data_clinical_files, out_dir, state):
+    for fname in [cbioportal_merge.DATA_CNA_FILE, cbioportal_merge.DATA_ASCNA_FILE]:
+        with open(os.path.join(out_dir, fname), 'w') as out:
+            clin_data_merge.merge_cna_fusions(inputs.get(fname, []), out, fillna=True)
+
+def stage_mutations(inputs, sample_data_clinical_files, out_dir, state):
+    for fname in [cbioportal_merge.DATA_FUSION_FILE, cbioportal_merge.DATA_SV_FILE]:
+        with open(os.path.join(out_dir, fname), 'w') as out:
+            clin_data_merge.merge_mutations(inputs.get(fname, []), out)
+    for fname in [cbioportal_merge.DATA_MUTATIONS_FILE, cbioportal_merge.DATA_MUTATIONS_UNCALLED_FILE]:
+        with open(os.path.join(out_dir, fname), 'w') as out:
+            clin_data_merge.merge_mutations(inputs.get(fname, []), out, deduplicate=True)
+
+def stage_meta(inputs, sample_data_clinical_files, out_dir, state):
+    params = {'study_id': STUDY_ID, 'desc': None, 'title': None, 'clin_sample_df': state['clin_sample_df']}
+    clin_meta_merge.get_meta_study(inputs.get(cbioportal_merge.META_STUDY_FILE, []), params)
+    clin_meta_merge.make_meta_info(STUDY_ID)
+
+def stage_case_lists(inputs, sample_data_clinical_files, out_dir, state):
+    for fname, case_type in [(cbioportal_merge.CASE_LISTS_ALL, "all"), (cbioportal_merge.CASE_LISTS_CNA, "cna"),
+            (cbioportal_merge.CASE_LISTS_CNASEQ, "cnaseq"), (cbioportal_merge.CASE_LISTS_SEQ, "sequenced")]:
+        case_lists_merge.make_case_lists(inputs.get(fname, []), STUDY_ID, case_type)
+
+def stage_seg(inputs, sample_data_clinical_files, out_dir, state):
+    seg_file = STUDY_ID + "_data_cna_hg19.seg"
+    with open(os.path.join(out_dir, seg_file), 'w') as out:
+        seg_merge.load_seg_data(inputs.get(cbioportal_merge.SEG_DATA_GLOB, []), out, index_file=os.path.join(out_dir, seg_file + cbioportal_merge.SEG_INDEX_SUFFIX))
+    seg_merge.create_seg_meta(inputs.get(cbioportal_merge.SEG_META_GLOB, []), STUDY_ID, seg_file)
+
+# In the order runner depends on them: meta reads the merged sample table from clinical
+STAGES = [('clinical', stage_clinical), ('cna', stage_cna), ('mutations', stage_mutations),
+    ('meta', stage_meta), ('case_lists', stage_case_lists), ('seg', stage_seg)]
+
+def measure(func, repeat):
+    seconds = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(seconds), 'all_seconds': seconds, 'peak_traced_bytes': peak}
+
+def run(directories, sample_data_clinical_files, repeat, jobs):
+    parallel.set_jobs(jobs)
+    parse_cache.configure(None, 0)
+    inputs = get_inputs(directories)
+    results = dict()
+    with tempfile.TemporaryDirectory(prefix="aion_benchmark_") as out_dir:
+        os.makedirs(os.path.join(out_dir, "case_lists"))
+        state = dict()
+        for name, stage in STAGES:
+            results[name] = measure(lambda: stage(inputs, sample_data_clinical_files, out_dir, state), repeat)
+        request_dict = {'directories': directories, 'project_desc': "Benchmark", 'project_title': None,
+            'sample_data_clinical_files': sample_data_clinical_files, 'study_id': STUDY_ID,
+            'output_directory': os.path.join(out_dir, "runner"), 'jobs': jobs}
+        results['runner'] = measure(lambda: cbioportal_merge.runner(request_dict), repeat)
+    return results
+
+def get_input_stats(directories, sample_data_clinical_files):
+    files = [fpath for fpaths in get_inputs(directories).values() for fpath in fpaths] + list(sample_data_clinical_files)
+    return {'directories': len(directories), 'files': len(files), 'bytes': sum(os.path.getsize(fpath) for fpath in files)}
+
+def get_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directories", nargs="+", help="Existing project directories to merge instead of generating synthetic ones")
+    parser.add_argument("--sample_data_clinical_files", nargs="*", default=[], help="Sample data clinical files to merge with --directories")
+    generate_projects.add_scale_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions per stage; the best run is reported")
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs passed to the merge")
+    parser.add_argument("--report_file", help="Write the JSON report here instead of printing it")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="aion_projects_") as projects_dir:
+        if args.directories:
+            directories, sample_data_clinical_files = args.directories, args.sample_data_clinical_files
+            scale = None
+        else:
+            directories, sample_data_clinical_file = generate_projects.generate(projects_dir, args.projects, args.samples, args.mutations, args.genes, args.seg_rows, args.seed)
+            sample_data_clinical_files = [sample_data_clinical_file]
+            scale = {'projects': args.projects, 'samples': args.samples, 'mutations': args.mutations,
+                'genes': args.genes, 'seg_rows': args.seg_rows, 'seed': args.seed}
+        report = {
+            'version': get_version(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'jobs': args.jobs,
+            'repeat': args.repeat,
+            'scale': scale,
+            'inputs': get_input_stats(directories, sample_data_clinical_files),
+            'stages': run(directories, sample_data_clinical_files, args.repeat, args.jobs),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    if args.report_file:
+        with open(args.report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
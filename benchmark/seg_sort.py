@@ -0,0 +1,48 @@
+import argparse
+import json
+import tempfile
+import time
+
+import numpy as np
+
+import common.seg_merge as seg_merge
+
+# Times the external sort of seg_merge.sort_lines on synthetic seg rows and checks that its
+# output matches a stable in-memory sort. Rows share few distinct keys and --chunksize is
+# small, so there are more runs than seg_merge.SEG_MERGE_FANIN and many ties between runs.
+
+def make_lines(num_rows, num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, num_samples, num_rows)
+    chroms = rng.choice(["1", "2", "X"], num_rows)
+    starts = rng.integers(0, 3, num_rows) * 1000
+    return ["S%i\t%s\t%i\t%i\t10\t%i\n" % (sample, chrom, start, start + 500, i)
+        for i, (sample, chrom, start) in enumerate(zip(samples, chroms, starts))]
+
+def run(num_rows, num_samples, chunksize, repeat):
+    lines = make_lines(num_rows, num_samples)
+    expected = sorted(lines, key=seg_merge.get_line_key)
+    times = list()
+    for _ in range(repeat):
+        chunks = (lines[start:start + chunksize] for start in range(0, len(lines), chunksize))
+        with tempfile.TemporaryDirectory(prefix="aion_seg_") as tmp_dir:
+            start = time.perf_counter()
+            result = [line for block in seg_merge.sort_lines(chunks, tmp_dir, chunksize) for line in block]
+            times.append(time.perf_counter() - start)
+        if result != expected:
+            raise AssertionError("sort_lines output differs from a stable sort")
+    return {
+        'rows': num_rows,
+        'runs': -(-num_rows // chunksize),
+        'fanin': seg_merge.SEG_MERGE_FANIN,
+        'seconds': min(times),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000, help="Number of synthetic seg rows")
+    parser.add_argument("--samples", type=int, default=5, help="Number of distinct samples")
+    parser.add_argument("--chunksize", type=int, default=100, help="Rows per sorted run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions; the best run is reported")
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.samples, args.chunksize, args.repeat), indent=2))
@@ -0,0 +1,86 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import common.clinical_definitions as clinical_definitions
+
+# Checks the startup of the command line tools: `--help` of cbioportal_merge.py and
+# batch_merge.py must not import the modules that are deferred until a merge starts, and
+# must take at most --target_seconds longer than starting the interpreter alone. Also
+# checks that the compiled clinical definitions match data.yaml. Exits with status 1 when
+# a check fails, so it can gate a build.
+#
+# Run from the repository root:
+#   python -m benchmark.startup
+
+COMMANDS = [["cbioportal_merge.py", "--help"], ["batch_merge.py", "--help"]]
+DEFERRED_MODULES = ["pandas", "numpy", "ruamel", "requests"]
+TARGET_SECONDS = 0.15 # startup time allowed on top of the bare interpreter
+
+# Modules of DEFERRED_MODULES imported by importing the entry points and parsing arguments
+IMPORT_CHECK = """
+import sys
+import cbioportal_merge, batch_merge
+cbioportal_merge.get_parser().parse_args(['--directories', 'd', '--project_desc', 'd', '--study_id', 's'])
+print(' '.join(name for name in %r if name in sys.modules))
+"""
+
+def time_command(args, repeat):
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def time_definitions(repeat):
+    json_times = list()
+    yaml_times = list()
+    for _ in range(repeat):
+        clinical_definitions._definitions = None
+        start = time.perf_counter()
+        clinical_definitions.get_definitions()
+        json_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        clinical_definitions.read_source()
+        yaml_times.append(time.perf_counter() - start)
+    return {'compiled_seconds': min(json_times), 'yaml_seconds': min(yaml_times)}
+
+def run(repeat, target_seconds):
+    failures = list()
+    interpreter = time_command(["-c", "pass"], repeat)
+    commands = dict()
+    for args in COMMANDS:
+        seconds = time_command(args, repeat)
+        commands[" ".join(args)] = {'seconds': seconds, 'over_interpreter_seconds': seconds - interpreter}
+        if seconds - interpreter > target_seconds:
+            failures.append("%s takes %.3fs over the interpreter's startup (target %.3fs)" % (" ".join(args), seconds - interpreter, target_seconds))
+
+    result = subprocess.run([sys.executable, "-c", IMPORT_CHECK % DEFERRED_MODULES], stdout=subprocess.PIPE, check=True, text=True)
+    imported = result.stdout.split()
+    if imported:
+        failures.append("Imported before a merge starts: %s" % ", ".join(imported))
+
+    if clinical_definitions.get_definitions() != clinical_definitions.read_source():
+        failures.append("%s is out of date; run python -m common.clinical_definitions" % clinical_definitions.COMPILED_FILE)
+
+    return {
+        'interpreter_seconds': interpreter,
+        'target_seconds': target_seconds,
+        'commands': commands,
+        'deferred_modules_imported': imported,
+        'definitions': time_definitions(repeat),
+        'failures': failures,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions; the best run is reported")
+    parser.add_argument("--target_seconds", type=float, default=TARGET_SECONDS, help="Startup time allowed on top of starting the interpreter")
+    args = parser.parse_args()
+    report = run(args.repeat, args.target_seconds)
+    print(json.dumps(report, indent=2))
+    if report['failures']:
+        sys.exit(1)
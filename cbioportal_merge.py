@@ -1,14 +1,27 @@
 import os,sys
-import pkgutil
+import functools
 import argparse
-import pandas as pd
-import glob
+import json
 
-import common.clinical_data_merge as clin_data_merge
-import common.clinical_meta_merge as clin_meta_merge
-import common.case_lists_merge as case_lists_merge
-import common.seg_merge as seg_merge
+import common.header_schema as header_schema
+import common.sample_subset as sample_subset
+import common.compression as compression
+import common.inventory as inventory
+import common.parallel as parallel
+import common.manifest as manifest
+import common.validation as validation
+import common.profiling as profiling
+from common.atomic_writer import atomic_open
+from common.lazy_import import LazyModule
 from typing import TypeVar
+
+# pandas, numpy and ruamel are only imported once a merge starts
+clin_data_merge = LazyModule("common.clinical_data_merge")
+clin_meta_merge = LazyModule("common.clinical_meta_merge")
+case_lists_merge = LazyModule("common.case_lists_merge")
+seg_merge = LazyModule("common.seg_merge")
+parse_cache = LazyModule("common.parse_cache")
+
 # Files to be merged
 CLINICAL_DATA_PATIENT_FILE = "data_clinical_patient.txt"
 CLINICAL_DATA_SAMPLE_FILE = "data_clinical_sample.txt"
@@ -25,18 +38,27 @@ CASE_LISTS_ALL = "case_lists/cases_all.txt"
 CASE_LISTS_CNASEQ = "case_lists/cases_cnaseq.txt"
 CASE_LISTS_CNA = "case_lists/cases_cna.txt"
 CASE_LISTS_SEQ = "case_lists/cases_sequenced.txt"
+SEG_DATA_GLOB = "*data*.seg"
+SEG_META_GLOB = "*meta*seg.txt"
+
+INPUT_FILES = [CLINICAL_DATA_SAMPLE_FILE, CLINICAL_DATA_PATIENT_FILE, META_STUDY_FILE, DATA_CNA_FILE, DATA_ASCNA_FILE,
+    DATA_FUSION_FILE, DATA_SV_FILE, DATA_MUTATIONS_FILE, DATA_MUTATIONS_UNCALLED_FILE,
+    CASE_LISTS_ALL, CASE_LISTS_CNASEQ, CASE_LISTS_CNA, CASE_LISTS_SEQ]
+INPUT_GLOBS = [SEG_DATA_GLOB, SEG_META_GLOB]
+DEFAULT_CACHE_SIZE_MB = 10240
+SEG_INDEX_SUFFIX = ".idx" # per-sample byte offsets written next to the merged seg file
+
+# Outputs that an incremental merge appends new rows to
+APPENDABLE_FILES = [DATA_FUSION_FILE, DATA_SV_FILE, DATA_MUTATIONS_FILE, DATA_MUTATIONS_UNCALLED_FILE, SEG_DATA_GLOB]
 
-class NonNoneSet(set):
+# Set that ignores None and iterates in insertion order, so the files of each type are
+# merged in the order the directories were given
+class NonNoneSet(dict):
     def add(self, element: TypeVar("_T")) -> None:
         if element != None:
-            return super().add(element)
+            self[element] = None
 
 
-def add_file_to_merge(dirpath, fname):
-    fpath = os.path.join(dirpath, fname)
-    if os.path.exists(fpath):
-        return fpath
-
 def make_directory(path):
     try:
         if not os.path.exists(path):
@@ -44,21 +66,118 @@ def make_directory(path):
     except OSError:
         print ("Creation of the directory %s failed" % path)
 
-def get_file_from_glob(path):
-    result = glob.glob(path)
-    if len(result) > 1:
-        print("Found multiple files when there should only be one: %s" % ";".join(result))
-        sys.exit(1)
-    if result:
-        return result[0]
+# Maps each input file name (or seg glob) found in directory to its path
+# Inputs may be gzip or zstd compressed (see common/compression.py)
+def find_input_files(directory):
+    found = inventory.scan_directory(directory, INPUT_FILES, INPUT_GLOBS)
+    return dict((name, input_file.path) for name, input_file in found.items())
+
+# Options that must match the previous run for its output to be reused
+def get_manifest_options(request_dict):
+    options = dict()
+    options['study_id'] = request_dict['study_id']
+    options['dedup_keep'] = request_dict.get('dedup_keep') or 'first'
+    options['maf_fill_value'] = get_maf_fill_value(request_dict)
+    options['compress_output'] = request_dict.get('compress_output')
+    sample_filter = get_sample_filter(request_dict)
+    options['sample_filter'] = sample_filter.digest if sample_filter is not None else None
+    options['sample_data_clinical_files'] = list(request_dict.get('sample_data_clinical_files') or [])
+    return options
+
+def get_sample_filter(request_dict):
+    return sample_subset.load_sample_filter(request_dict.get('include_samples'), request_dict.get('exclude_samples'))
+
+def get_maf_fill_value(request_dict):
+    fill_value = request_dict.get('maf_fill_value')
+    return clin_data_merge.MUTATIONS_FILL_VALUE if fill_value is None else fill_value
+
+# Returns the directories added since the previous merge, or None when a full merge is
+# needed because the manifest is missing, the options differ or an input changed
+def plan_incremental(previous_dir, previous_manifest, options, files_by_dir, sample_data_clinical_files):
+    if previous_manifest is None:
+        print("No manifest found in %s; running a full merge" % previous_dir)
+        return None
+    if previous_manifest['options'] != options:
+        print("Merge options differ from the previous merge in %s; running a full merge" % previous_dir)
+        return None
+    if not manifest.is_unchanged(previous_manifest['sample_data_clinical_files'], sample_data_clinical_files or []):
+        print("Sample data clinical files changed since the previous merge; running a full merge")
+        return None
+    current_files = dict()
+    for directory in files_by_dir:
+        current_files[directory] = list(files_by_dir[directory].values())
+    new_dirs, changed_dirs, removed_dirs = manifest.compare_manifest(previous_manifest, current_files)
+    if changed_dirs or removed_dirs:
+        print("Directories changed or removed since the previous merge (%s); running a full merge" % ";".join(changed_dirs + removed_dirs))
+        return None
+    return new_dirs
+
+# Submits the merges in tasks (key -> (input files, function)) in decreasing order of input
+# size; returns their futures in the order of tasks
+def submit_largest_first(pool, tasks, inputs):
+    futures = dict()
+    for key in sorted(tasks, key=lambda key: inputs.get_size(tasks[key][0]), reverse=True):
+        futures[key] = pool.submit(tasks[key][1])
+    return dict((key, futures[key]) for key in tasks)
 
 def write_dict(output_dir, d):
     for key in d:
         fname = os.path.basename(key)
         fpath = os.path.join(output_dir, fname)
-        o = open(fpath, 'w')
-        o.write(d[key])
-        o.close()
+        with atomic_open(fpath) as o:
+            profiling.counting(o).write(d[key])
+
+# Runs a merge that writes into an output handle; fpath only appears once the merge completes.
+# A .gz or .zst fpath is compressed as it is written.
+def merge_to_file(fpath, merge_func, file_list, **kwargs):
+    with profiling.stage(os.path.basename(fpath)), atomic_open(fpath, codec=compression.get_codec(fpath)) as out:
+        return merge_func(file_list, profiling.counting(out), **kwargs)
+
+# With a sample filter, patients are kept when one of their merged samples is, so the
+# patient merge waits for the sample merge
+def merge_patients_to_file(fpath, file_list, additional_df, schema, sample_filter, samples):
+    patient_filter = None
+    if sample_filter is not None:
+        patient_filter = sample_subset.SampleFilter(include=samples.result()['PATIENT_ID'].astype(str))
+    return merge_to_file(fpath, clin_data_merge.run_merge_patient, file_list, additional_df=additional_df, schema=schema, sample_filter=patient_filter)
+
+def merge_mutations_to_file(file_list, fpath, chunksize, fill_value, deduplicate=False, keep='first', base_file=None, sample_ids=None, schema=None, sample_filter=None):
+    stats = merge_to_file(fpath, clin_data_merge.merge_mutations, file_list, fill_value=fill_value, deduplicate=deduplicate, keep=keep, chunksize=chunksize, base_file=base_file, sample_ids=sample_ids, schema=schema, sample_filter=sample_filter)
+    if stats['duplicates_removed']:
+        print("Removed %i duplicate rows from %s" % (stats['duplicates_removed'], os.path.basename(fpath)))
+    return stats
+
+# Case lists built from the sample ids of the merged data; the cna, sequenced and cnaseq
+# lists are only written when they have samples. clinical_ids is the SAMPLE_ID column of the
+# merged sample table, listed as it is written to data_clinical_sample.txt.
+def make_derived_case_lists(study_id, clinical_ids, cna_ids, sequenced_ids):
+    clinical_ids = clin_data_merge.format_column(clinical_ids)
+    sequenced_set = set(sequenced_ids)
+    cases = dict()
+    cases[CASE_LISTS_ALL] = case_lists_merge.make_derived_case_list(clinical_ids, study_id, "all")
+    if cna_ids:
+        cases[CASE_LISTS_CNA] = case_lists_merge.make_derived_case_list(cna_ids, study_id, "cna")
+    if sequenced_ids:
+        cases[CASE_LISTS_SEQ] = case_lists_merge.make_derived_case_list(sequenced_ids, study_id, "sequenced")
+    cnaseq_ids = [sample_id for sample_id in cna_ids if sample_id in sequenced_set]
+    if cnaseq_ids:
+        cases[CASE_LISTS_CNASEQ] = case_lists_merge.make_derived_case_list(cnaseq_ids, study_id, "cnaseq")
+    return cases
+
+# Checks the merged output from the ids collected by the merge stages (see common/validation.py)
+def validate_output(output_dir, merged, data_sample_ids, cases, meta):
+    sample_df = merged[CLINICAL_DATA_SAMPLE_FILE]
+    patient_df = merged[CLINICAL_DATA_PATIENT_FILE]
+    samples = dict()
+    if 'SAMPLE_ID' in sample_df.columns:
+        patient_ids = clin_data_merge.format_column(sample_df['PATIENT_ID']) if 'PATIENT_ID' in sample_df.columns else [""] * len(sample_df)
+        samples = dict(zip(clin_data_merge.format_column(sample_df['SAMPLE_ID']), patient_ids))
+    patients = clin_data_merge.format_column(patient_df['PATIENT_ID']) if 'PATIENT_ID' in patient_df.columns else []
+    return validation.validate(output_dir, samples, patients, data_sample_ids, cases, meta)
+
+def write_report(fpath, report):
+    with open(fpath, 'w') as o:
+        json.dump(report, o, indent=2)
 
 def get_dir_list(dirs):
     dir_list = list()
@@ -67,7 +186,37 @@ def get_dir_list(dirs):
     return dir_list
 
 def runner(request_dict):
+    configure(request_dict)
+    if request_dict.get('profile') or request_dict.get('profile_trace'):
+        profiling.enable()
+    try:
+        return merge_study(request_dict)
+    finally:
+        profiling.write_profile(request_dict.get('profile'), request_dict.get('profile_trace'))
+        profiling.disable()
+
+# Process-wide settings: thread pools and the parse cache
+def configure(request_dict):
+    parallel.set_jobs(request_dict.get('jobs'))
+    cache_size_mb = request_dict.get('cache_size_mb')
+    if cache_size_mb is None:
+        cache_size_mb = DEFAULT_CACHE_SIZE_MB
+    parse_cache.configure(request_dict.get('cache_dir'), cache_size_mb * 1024 * 1024)
+
+# Merges one study; safe to run for several studies at once once configure has been called
+def merge_study(request_dict):
     dir_list = get_dir_list(request_dict['directories'])
+    # Find the files to merge in every directory, listing the directories concurrently; the
+    # sizes and mtimes found stand in for stat calls until the merge is done
+    with profiling.stage("discover"):
+        inputs = inventory.scan(dir_list, INPUT_FILES, INPUT_GLOBS)
+    inventory.register(inputs)
+    try:
+        return merge_inputs(request_dict, dir_list, inputs)
+    finally:
+        inventory.unregister(inputs)
+
+def merge_inputs(request_dict, dir_list, inputs):
     study_id = request_dict['study_id'] 
     project_desc = request_dict['project_desc']
     title = request_dict['project_title']
@@ -75,6 +224,32 @@ def runner(request_dict):
     sample_data_clinical_files = request_dict['sample_data_clinical_files']
 
     make_directory(output_dir)
+    report = dict()
+
+    files_by_dir = dict()
+    for directory in dir_list:
+        files_by_dir[directory] = inputs.get_paths(directory)
+
+    # In incremental mode, the previous output stands in for the directories already merged
+    # into it: it holds the same files a project directory does. MAF-like and seg outputs
+    # are appended to rather than re-read, so they are kept apart as base files.
+    merge_dirs = dir_list
+    base_files = dict()
+    previous_dir = request_dict.get('incremental_from')
+    options = get_manifest_options(request_dict)
+    previous_manifest = manifest.load_manifest(previous_dir or output_dir)
+    if previous_dir:
+        new_dirs = plan_incremental(previous_dir, previous_manifest, options, files_by_dir, sample_data_clinical_files)
+        if new_dirs is not None:
+            report['incremental'] = {'previous_output': previous_dir, 'new_directories': new_dirs}
+            if not new_dirs and os.path.abspath(previous_dir) == os.path.abspath(output_dir):
+                print("No new directories since the previous merge; %s is up to date" % output_dir)
+                return report
+            previous_files = find_input_files(previous_dir)
+            for fname in APPENDABLE_FILES:
+                base_files[fname] = previous_files.pop(fname, None)
+            files_by_dir[previous_dir] = previous_files
+            merge_dirs = [previous_dir] + new_dirs
 
     # load common files into sets
     samp_files = NonNoneSet()
@@ -93,106 +268,160 @@ def runner(request_dict):
     seg_data_files = NonNoneSet()
     seg_meta_files = NonNoneSet()
 
-    for directory in dir_list:
-        samp_files.add(add_file_to_merge(directory, CLINICAL_DATA_SAMPLE_FILE))
-        patient_files.add(add_file_to_merge(directory, CLINICAL_DATA_PATIENT_FILE))
-        meta_study_files.add(add_file_to_merge(directory, META_STUDY_FILE))
-        data_cna_files.add(add_file_to_merge(directory, DATA_CNA_FILE))
-        data_ascna_files.add(add_file_to_merge(directory, DATA_ASCNA_FILE))
-        data_fusions_files.add(add_file_to_merge(directory, DATA_FUSION_FILE))
-        data_sv_files.add(add_file_to_merge(directory, DATA_SV_FILE))
-        data_mutations_files.add(add_file_to_merge(directory, DATA_MUTATIONS_FILE))
-        data_mutations_uncalled_files.add(add_file_to_merge(directory, DATA_MUTATIONS_UNCALLED_FILE))
-        cases_all.add(add_file_to_merge(directory,CASE_LISTS_ALL))
-        cases_cnaseq.add(add_file_to_merge(directory,CASE_LISTS_CNASEQ))
-        cases_cna.add(add_file_to_merge(directory,CASE_LISTS_CNA))
-        cases_seq.add(add_file_to_merge(directory,CASE_LISTS_SEQ))
-        seg_data_files.add(get_file_from_glob(os.path.join(directory, "*data*.seg")))
-        seg_meta_files.add(get_file_from_glob(os.path.join(directory, "*meta*seg.txt")))
+    for directory in merge_dirs:
+        found = files_by_dir[directory]
+        samp_files.add(found.get(CLINICAL_DATA_SAMPLE_FILE))
+        patient_files.add(found.get(CLINICAL_DATA_PATIENT_FILE))
+        meta_study_files.add(found.get(META_STUDY_FILE))
+        data_cna_files.add(found.get(DATA_CNA_FILE))
+        data_ascna_files.add(found.get(DATA_ASCNA_FILE))
+        data_fusions_files.add(found.get(DATA_FUSION_FILE))
+        data_sv_files.add(found.get(DATA_SV_FILE))
+        data_mutations_files.add(found.get(DATA_MUTATIONS_FILE))
+        data_mutations_uncalled_files.add(found.get(DATA_MUTATIONS_UNCALLED_FILE))
+        cases_all.add(found.get(CASE_LISTS_ALL))
+        cases_cnaseq.add(found.get(CASE_LISTS_CNASEQ))
+        cases_cna.add(found.get(CASE_LISTS_CNA))
+        cases_seq.add(found.get(CASE_LISTS_SEQ))
+        seg_data_files.add(found.get(SEG_DATA_GLOB))
+        seg_meta_files.add(found.get(SEG_META_GLOB))
+
+    # Read the header lines of every data file once, before any data is parsed; the merges
+    # below take their columns and clinical attributes from this schema
+    data_files = [samp_files, patient_files, data_cna_files, data_ascna_files, data_fusions_files, data_sv_files,
+        data_mutations_files, data_mutations_uncalled_files, seg_data_files, base_files.values()]
+    schema = profiling.call("schema", header_schema.scan, [fname for files in data_files for fname in files if fname])
+
+    # Samples left out by --include_samples/--exclude_samples are dropped by every reader
+    sample_filter = get_sample_filter(request_dict)
 
     ## Load the sample data clinical files and retrieve the extra sample and patient dataframes
-    sample_df, patient_df = clin_data_merge.read_sample_data_clinical(sample_data_clinical_files)
-    
-    ## Begin clinical data file processing
-
-    data_clinical_sample = clin_data_merge.run_merge(samp_files, additional_df=sample_df)
-    data_clinical_patient = clin_data_merge.run_merge_patient(patient_files, additional_df=patient_df)
-    data_cna = clin_data_merge.merge_cna_fusions(data_cna_files, fillna=True)
-    data_ascna = clin_data_merge.merge_cna_fusions(data_ascna_files, fillna=True)
-    data_fusions = clin_data_merge.merge_mutations(data_fusions_files)
-    data_sv = clin_data_merge.merge_mutations(data_sv_files)
-    data_mutations = clin_data_merge.merge_mutations(data_mutations_files, deduplicate=True)
-    if data_mutations_uncalled_files:
-        data_mutations_uncalled = clin_data_merge.merge_mutations(data_mutations_uncalled_files, deduplicate=True)
-    else:
-        data_mutations_uncalled = None
-
-    # write out data_clinical_patient/sample, data_cna
-    data_map_for_write = dict()
-    data_map_for_write[CLINICAL_DATA_SAMPLE_FILE] = data_clinical_sample
-    data_map_for_write[CLINICAL_DATA_PATIENT_FILE] = data_clinical_patient
-    data_map_for_write[DATA_CNA_FILE] = data_cna
-    data_map_for_write[DATA_FUSION_FILE] = data_fusions
-    data_map_for_write[DATA_SV_FILE] = data_sv
-    data_map_for_write[DATA_MUTATIONS_FILE] = data_mutations
-    if data_mutations_uncalled:
-        data_map_for_write[DATA_MUTATIONS_UNCALLED_FILE] = data_mutations_uncalled
-    data_map_for_write[DATA_ASCNA_FILE] = data_ascna
-    write_dict(output_dir, data_map_for_write)
-
-    ## Begin meta file processing
-    meta_clinical_patient = (clin_meta_merge.make_meta_clinical(study_id, "PATIENT_ATTRIBUTES"))
-    meta_clinical_sample = (clin_meta_merge.make_meta_clinical(study_id, "SAMPLE_ATTRIBUTES"))
-
-    data_clinical_sample_merged_file = os.path.join(output_dir, CLINICAL_DATA_SAMPLE_FILE)
-
-    params = dict()
-    params['study_id'] = study_id
-    params['desc'] = project_desc
-    params['title'] = title 
-    params['clin_sample_file'] = data_clinical_sample_merged_file # unfortunately needed from merged data clinical sample file to resolve type_of_cancer
-    meta_study = (clin_meta_merge.get_meta_study(meta_study_files, params))
-
-    # write out meta_study, meta_clinical_patient/sample, other_meta
-    meta = clin_meta_merge.make_meta_info(study_id)
-    # Do not write meta_mutations_uncalled.txt if data_mutations_uncalled does not exist
-    if not data_mutations_uncalled:
-        meta.pop('meta_mutations_uncalled.txt',None)
-    meta[META_STUDY_FILE] = meta_study
-    meta[CLINICAL_META_PATIENT_FILE] = meta_clinical_patient
-    meta[CLINICAL_META_SAMPLE_FILE] = meta_clinical_sample
-    write_dict(output_dir, meta)
-
-    ## Begin writing case list files
-    cases_all_merged = (case_lists_merge.make_case_lists(cases_all, study_id, "all"))
-    cases_cna_merged = (case_lists_merge.make_case_lists(cases_cna, study_id, "cna"))
-    cases_cnaseq_merged = (case_lists_merge.make_case_lists(cases_cnaseq, study_id, "cnaseq"))
-    cases_seq_merged = (case_lists_merge.make_case_lists(cases_seq, study_id, "sequenced"))
-
-    # write out case files
-    cases_path = os.path.join(output_dir, "case_lists")
-    make_directory(cases_path)
-    cases = dict()
-    cases[CASE_LISTS_ALL] = cases_all_merged
-    cases[CASE_LISTS_CNA] = cases_cna_merged
-    cases[CASE_LISTS_CNASEQ] = cases_cnaseq_merged
-    cases[CASE_LISTS_SEQ] = cases_seq_merged
-    write_dict(cases_path, cases)
-
-    ## Begin writing seg files
-    seg_data_merged_file_name = study_id + "_data_cna_hg19.seg"
+    sample_df, patient_df = profiling.call("sample_data_clinical", clin_data_merge.read_sample_data_clinical, sample_data_clinical_files, sample_filter)
+
+    chunksize = request_dict.get('maf_chunksize') or clin_data_merge.MUTATIONS_CHUNKSIZE
+    keep = request_dict.get('dedup_keep') or 'first'
+    fill_value = get_maf_fill_value(request_dict)
+    derive_case_lists = request_dict.get('derive_case_lists')
+    validate = request_dict.get('validate')
+    # Samples of the rows of each MAF-like output, filled in by its merge: the mutations for
+    # --derive_case_lists, and all of them for --validate
+    maf_sample_ids = dict()
+    for fname in [DATA_FUSION_FILE, DATA_SV_FILE, DATA_MUTATIONS_FILE, DATA_MUTATIONS_UNCALLED_FILE]:
+        if validate or (derive_case_lists and fname == DATA_MUTATIONS_FILE):
+            maf_sample_ids[fname] = dict()
+    sequenced_ids = maf_sample_ids.get(DATA_MUTATIONS_FILE)
+    data_mutations_uncalled = bool(data_mutations_uncalled_files) or bool(base_files.get(DATA_MUTATIONS_UNCALLED_FILE))
+    # --compress_output applies to the data files; meta files and case lists stay plain text
+    suffix = compression.CODEC_SUFFIXES.get(request_dict.get('compress_output'), "")
+    seg_data_merged_file_name = study_id + "_data_cna_hg19.seg" + suffix
     seg_meta_merged_file_name = study_id + "_meta_cna_hg19_seg.txt"
-    seg_data_merged_file = os.path.join(output_dir, seg_data_merged_file_name)
-    seg_data = seg_merge.load_seg_data(seg_data_files)
-    seg_meta = seg_merge.create_seg_meta(seg_meta_files, study_id, seg_data_merged_file_name)
 
-    # write out seg file
-    seg = dict()
-    seg[seg_data_merged_file_name] = seg_data
-    seg[seg_meta_merged_file_name] = seg_meta
-    write_dict(output_dir, seg)
+    # Every data type is merged independently on the stage pool and written straight to
+    # its output file; results are collected in submission order so the output does not
+    # depend on --jobs
+    with parallel.stage_pool() as pool:
+        ## Begin clinical data file processing
+        data_map_for_write = dict()
+        data_map_for_write[CLINICAL_DATA_SAMPLE_FILE] = pool.submit(merge_to_file, os.path.join(output_dir, CLINICAL_DATA_SAMPLE_FILE + suffix), clin_data_merge.run_merge, samp_files, additional_df=sample_df, schema=schema, sample_filter=sample_filter)
+        data_map_for_write[CLINICAL_DATA_PATIENT_FILE] = pool.submit(merge_patients_to_file, os.path.join(output_dir, CLINICAL_DATA_PATIENT_FILE + suffix), patient_files, patient_df, schema, sample_filter, data_map_for_write[CLINICAL_DATA_SAMPLE_FILE])
 
-if __name__ == "__main__":
+        # The CNA, MAF-like and seg merges are independent of each other and take most of
+        # the time; starting the largest first keeps one from starting last when --jobs is
+        # smaller than the number of merges
+        tasks = dict()
+        tasks[DATA_CNA_FILE] = (data_cna_files, functools.partial(merge_to_file, os.path.join(output_dir, DATA_CNA_FILE + suffix), clin_data_merge.merge_cna_fusions, data_cna_files, fillna=True, schema=schema, sample_filter=sample_filter))
+        tasks[DATA_ASCNA_FILE] = (data_ascna_files, functools.partial(merge_to_file, os.path.join(output_dir, DATA_ASCNA_FILE + suffix), clin_data_merge.merge_cna_fusions, data_ascna_files, fillna=True, schema=schema, sample_filter=sample_filter))
+
+        # MAF-like files are streamed straight to the output directory
+        tasks[DATA_FUSION_FILE] = (list(data_fusions_files) + [base_files.get(DATA_FUSION_FILE)], functools.partial(merge_mutations_to_file, data_fusions_files, os.path.join(output_dir, DATA_FUSION_FILE + suffix), chunksize, fill_value, base_file=base_files.get(DATA_FUSION_FILE), sample_ids=maf_sample_ids.get(DATA_FUSION_FILE), schema=schema, sample_filter=sample_filter))
+        tasks[DATA_SV_FILE] = (list(data_sv_files) + [base_files.get(DATA_SV_FILE)], functools.partial(merge_mutations_to_file, data_sv_files, os.path.join(output_dir, DATA_SV_FILE + suffix), chunksize, fill_value, base_file=base_files.get(DATA_SV_FILE), sample_ids=maf_sample_ids.get(DATA_SV_FILE), schema=schema, sample_filter=sample_filter))
+        tasks[DATA_MUTATIONS_FILE] = (list(data_mutations_files) + [base_files.get(DATA_MUTATIONS_FILE)], functools.partial(merge_mutations_to_file, data_mutations_files, os.path.join(output_dir, DATA_MUTATIONS_FILE + suffix), chunksize, fill_value, deduplicate=True, keep=keep, base_file=base_files.get(DATA_MUTATIONS_FILE), sample_ids=sequenced_ids, schema=schema, sample_filter=sample_filter))
+        if data_mutations_uncalled:
+            tasks[DATA_MUTATIONS_UNCALLED_FILE] = (list(data_mutations_uncalled_files) + [base_files.get(DATA_MUTATIONS_UNCALLED_FILE)], functools.partial(merge_mutations_to_file, data_mutations_uncalled_files, os.path.join(output_dir, DATA_MUTATIONS_UNCALLED_FILE + suffix), chunksize, fill_value, deduplicate=True, keep=keep, base_file=base_files.get(DATA_MUTATIONS_UNCALLED_FILE), sample_ids=maf_sample_ids.get(DATA_MUTATIONS_UNCALLED_FILE), schema=schema, sample_filter=sample_filter))
+
+        ## Begin seg file processing
+        tasks[SEG_DATA_GLOB] = (list(seg_data_files) + [base_files.get(SEG_DATA_GLOB)], functools.partial(merge_to_file, os.path.join(output_dir, seg_data_merged_file_name), seg_merge.load_seg_data, seg_data_files, base_file=base_files.get(SEG_DATA_GLOB), sort=request_dict.get('sort_seg'), index_file=os.path.join(output_dir, seg_data_merged_file_name + SEG_INDEX_SUFFIX), schema=schema, sample_filter=sample_filter))
+        futures = submit_largest_first(pool, tasks, inputs)
+        data_map_for_write[DATA_CNA_FILE] = futures.pop(DATA_CNA_FILE)
+        data_map_for_write[DATA_ASCNA_FILE] = futures.pop(DATA_ASCNA_FILE)
+        seg_data = futures.pop(SEG_DATA_GLOB)
+        mutation_stats = futures
+
+        ## Begin case list processing
+        cases = dict()
+        if not derive_case_lists:
+            cases[CASE_LISTS_ALL] = pool.submit(profiling.call, CASE_LISTS_ALL, case_lists_merge.make_case_lists, cases_all, study_id, "all", sample_filter)
+            cases[CASE_LISTS_CNA] = pool.submit(profiling.call, CASE_LISTS_CNA, case_lists_merge.make_case_lists, cases_cna, study_id, "cna", sample_filter)
+            cases[CASE_LISTS_CNASEQ] = pool.submit(profiling.call, CASE_LISTS_CNASEQ, case_lists_merge.make_case_lists, cases_cnaseq, study_id, "cnaseq", sample_filter)
+            cases[CASE_LISTS_SEQ] = pool.submit(profiling.call, CASE_LISTS_SEQ, case_lists_merge.make_case_lists, cases_seq, study_id, "sequenced", sample_filter)
+
+        seg = dict()
+        seg[seg_meta_merged_file_name] = pool.submit(profiling.call, seg_meta_merged_file_name, seg_merge.create_seg_meta, seg_meta_files, study_id, seg_data_merged_file_name)
+
+        # wait for data_clinical_patient/sample, data_cna
+        merged = parallel.get_results(data_map_for_write)
+        report['mutations'] = parallel.get_results(mutation_stats)
+
+        if derive_case_lists:
+            cases = profiling.call("derived_case_lists", make_derived_case_lists, study_id, merged[CLINICAL_DATA_SAMPLE_FILE]['SAMPLE_ID'], merged[DATA_CNA_FILE], list(sequenced_ids))
+
+        ## Begin meta file processing
+        meta_clinical_patient = (clin_meta_merge.make_meta_clinical(study_id, "PATIENT_ATTRIBUTES", suffix))
+        meta_clinical_sample = (clin_meta_merge.make_meta_clinical(study_id, "SAMPLE_ATTRIBUTES", suffix))
+
+        params = dict()
+        params['study_id'] = study_id
+        params['desc'] = project_desc
+        params['title'] = title 
+        params['clin_sample_df'] = merged[CLINICAL_DATA_SAMPLE_FILE] # needed to resolve type_of_cancer
+        meta_study, report['oncotree'] = profiling.call(META_STUDY_FILE, clin_meta_merge.get_meta_study, meta_study_files, params)
+
+        # write out meta_study, meta_clinical_patient/sample, other_meta
+        meta = clin_meta_merge.make_meta_info(study_id, suffix)
+        # Do not write meta_mutations_uncalled.txt if data_mutations_uncalled does not exist
+        if not data_mutations_uncalled:
+            meta.pop('meta_mutations_uncalled.txt',None)
+        meta[META_STUDY_FILE] = meta_study
+        meta[CLINICAL_META_PATIENT_FILE] = meta_clinical_patient
+        meta[CLINICAL_META_SAMPLE_FILE] = meta_clinical_sample
+        profiling.call("write_meta", write_dict, output_dir, meta)
+
+        # write out case files
+        cases_path = os.path.join(output_dir, "case_lists")
+        make_directory(cases_path)
+        if not derive_case_lists:
+            cases = parallel.get_results(cases)
+        profiling.call("write_case_lists", write_dict, cases_path, cases)
+
+        # write out seg file
+        seg_samples = seg_data.result()
+        seg = parallel.get_results(seg)
+        profiling.call("write_seg_meta", write_dict, output_dir, seg)
+
+    if validate:
+        data_sample_ids = dict()
+        for fname in [DATA_CNA_FILE, DATA_ASCNA_FILE]:
+            data_sample_ids[fname + suffix] = merged[fname]
+        for fname in maf_sample_ids:
+            data_sample_ids[fname + suffix] = maf_sample_ids[fname]
+        data_sample_ids[seg_data_merged_file_name] = seg_samples
+        report['validation'] = profiling.call("validate", validate_output, output_dir, merged, data_sample_ids, cases, dict(meta, **seg))
+        validation.print_violations(report['validation'])
+
+    # record the inputs of this merge so the next one can run incrementally; inputs are
+    # only hashed for it in incremental mode (see common/manifest.py)
+    manifest_files = dict()
+    for directory in dir_list:
+        manifest_files[directory] = list(files_by_dir[directory].values())
+    new_manifest = profiling.call("manifest", manifest.build_manifest, options, manifest_files, sample_data_clinical_files or [],
+        previous=previous_manifest, hash_files=bool(previous_dir))
+    manifest.write_manifest(output_dir, new_manifest)
+
+    if request_dict.get('report_file'):
+        write_report(request_dict['report_file'], report)
+    return report
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--directories", nargs="+", required=True, help="List of directories to merge")
     parser.add_argument("--project_desc", required=True, help="Project description")
@@ -200,6 +429,28 @@ if __name__ == "__main__":
     parser.add_argument("--sample_data_clinical_files", required=False, help="Sample Data Clinical Files", nargs="*")
     parser.add_argument("--study_id", required=True, help="Study ID")
     parser.add_argument("--output_directory", required=False, help="Location of output directory")
+    parser.add_argument("--maf_chunksize", required=False, type=int, help="Number of rows read at a time when streaming MAF-like files (default: 100000)")
+    parser.add_argument("--maf_fill_value", required=False, help="Value written in MAF-like files for the columns an input file does not have (default: empty)")
+    parser.add_argument("--dedup_keep", required=False, choices=["first", "last"], default="first", help="Which copy of a duplicated mutation is kept: the one from the first or the last directory listed")
+    parser.add_argument("--include_samples", required=False, help="File listing the sample ids to merge, one per line; the data of every other sample is skipped while reading")
+    parser.add_argument("--exclude_samples", required=False, help="File listing sample ids to leave out of the merge, one per line")
+    parser.add_argument("--compress_output", required=False, choices=list(compression.CODEC_SUFFIXES), help="Write the merged data files gzip (gz) or zstd (zst) compressed; meta files and case lists are written as plain text")
+    parser.add_argument("--jobs", required=False, type=int, default=1, help="Number of merges and input file reads to run concurrently")
+    parser.add_argument("--incremental_from", required=False, help="Previous output directory of this study; only directories added since it was merged are read")
+    parser.add_argument("--cache_dir", required=False, help="Directory of a parse cache shared between merges; parsed input files are reused when their content is unchanged")
+    parser.add_argument("--cache_size_mb", required=False, type=int, default=DEFAULT_CACHE_SIZE_MB, help="Size above which the least recently used parse cache entries are evicted")
+    parser.add_argument("--derive_case_lists", required=False, action="store_true", help="Build the case lists from the sample ids in the merged clinical, CNA and mutation data instead of merging the projects' case list files")
+    parser.add_argument("--sort_seg", required=False, action="store_true", help="Sort the merged seg file by sample, chromosome and start")
+    parser.add_argument("--validate", required=False, action="store_true", help="Check that the samples of every data file and case list and the patients of every sample are in the clinical files, and that meta files name written data files; violations are printed and recorded in the --report_file JSON")
+    parser.add_argument("--profile", required=False, help="Write the time, CPU, memory, rows and bytes of every merge stage and input file read as JSON to this path")
+    parser.add_argument("--profile_trace", required=False, help="Write the stages and file reads as a Chrome trace (chrome://tracing, Perfetto) to this path")
+    parser.add_argument("--report_file", required=False, help="Write a JSON run report (e.g. duplicate mutation counts) to this path")
+    return parser
+
+if __name__ == "__main__":
+    parser = get_parser()
     args =  parser.parse_args()
     request_dict = vars(args)
-    runner(request_dict)
+    report = runner(request_dict)
+    if not report.get('validation', {'valid': True})['valid']:
+        sys.exit(1)
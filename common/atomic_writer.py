@@ -0,0 +1,21 @@
+import os
+import threading
+
+import common.compression as compression
+from contextlib import contextmanager
+
+# Opens a temporary file next to fpath and renames it over fpath only once the block
+# completes, so an interrupted merge never leaves a truncated output behind.
+# Any writable handle can stand in for the merge outputs; this is the one runner uses.
+# With a codec, text written is compressed on a background thread (see compression.py).
+@contextmanager
+def atomic_open(fpath, mode='w', codec=None):
+    dirname, fname = os.path.split(fpath)
+    tmp_path = os.path.join(dirname, ".%s.%i.%i.tmp" % (fname, os.getpid(), threading.get_ident()))
+    try:
+        with (open(tmp_path, mode) if codec is None else compression.open_output(tmp_path, codec)) as out:
+            yield out
+        os.replace(tmp_path, fpath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
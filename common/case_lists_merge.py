@@ -1,38 +1,21 @@
-import sys, os
-from ruamel import yaml
-import tempfile
-import shutil
+import common.parallel as parallel
+import common.profiling as profiling
+import common.compression as compression
+import common.meta_files as meta_files
 
-# Create tempfile version of files so that they can be modified for sample exclusions
-# obj contains project_id and fpath
-def return_tmpfiles_from_file_list(file_list):
-    new_file_list = list()
-    for i,f in enumerate(file_list):
-        fname =  "tmp_file_" + str(i) +"_" + os.path.basename(f)
-        tmp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(tmp_dir, fname)
-        shutil.copy2(f, temp_path)
-        new_file_list.append(temp_path)
-    return new_file_list
+# Standard cBioPortal category, name and description of each derived case list type
+DERIVED_CASE_LISTS = {
+    'all': ('all_cases_in_study', 'All samples', 'All samples'),
+    'cna': ('all_cases_with_cna_data', 'Samples with CNA data', 'Samples with CNA data'),
+    'sequenced': ('all_cases_with_mutation_data', 'Samples with mutation data', 'Samples with mutation data'),
+    'cnaseq': ('all_cases_with_mutation_and_cna_data', 'Samples with mutation and CNA data', 'Samples with both mutation and CNA data'),
+}
 
-# Need to replace tab characters with another delimiter so that the YAML parse works
-def modify_files_to_remove_tabs(tmp_files):
-    for f in tmp_files:
-        with open(f, 'r') as my_file:
-            data = my_file.readlines()
-            for i,line in enumerate(data):
-                line = line.replace(":\t",": ") #fixing inconsistent tab or space
-                data[i] = line.replace("\t", ",")
-        with open(f, 'w') as my_file:
-            my_file.writelines( data )
-    return tmp_files
-
-def make_case_lists(file_list, study_id, case_type):
-    tmp_files = return_tmpfiles_from_file_list(file_list)
-    tmp_files = modify_files_to_remove_tabs(tmp_files)
-    data = load_case_lists_files(tmp_files)
-    case_data = get_values(data) 
-    case_list_ids = get_case_list_ids(case_data)
+# With sample_filter, only the ids it keeps are listed
+def make_case_lists(file_list, study_id, case_type, sample_filter=None):
+    data = parallel.map_files(read_case_list_file, file_list)
+    case_data = meta_files.get_values(data) 
+    case_list_ids = get_case_list_ids(case_data, sample_filter)
     case_data['case_list_ids'] = case_list_ids
     case_data['cancer_study_identifier'] = study_id
     case_data['stable_id'] = study_id + "_" + case_type
@@ -46,6 +29,19 @@ def make_case_lists(file_list, study_id, case_type):
 
     return make_case_lists_string(case_data)
 
+# Builds a case list of case_type from the sample ids collected while merging the data files
+def make_derived_case_list(sample_ids, study_id, case_type):
+    category, name, desc = DERIVED_CASE_LISTS[case_type]
+    ids = list(dict.fromkeys(sample_ids))
+    case_data = dict()
+    case_data['case_list_category'] = category
+    case_data['stable_id'] = study_id + "_" + case_type
+    case_data['case_list_name'] = name
+    case_data['case_list_description'] = "%s (%i samples)" % (desc, len(ids))
+    case_data['cancer_study_identifier'] = study_id
+    case_data['case_list_ids'] = "\t".join(ids)
+    return make_case_lists_string(case_data)
+
 def make_case_lists_string(data):
     s = "case_list_category: %s\n" % data['case_list_category']
     s += "stable_id: %s\n" % data['stable_id']
@@ -55,28 +51,27 @@ def make_case_lists_string(data):
     s += "case_list_ids: %s\n" % data['case_list_ids']
     return s
 
-def get_case_list_ids(data):
+# Splits every case_list_ids value on tabs and commas, keeping the first occurrence of each id
+def get_case_list_ids(data, sample_filter=None):
     unedited_ids = data['case_list_ids']
-    id_set = set()
+    id_set = dict()
     for id_list in unedited_ids:
-        ids = id_list.split(",")
-        for i in ids:
+        for i in id_list.replace("\t", ",").split(","):
             i = i.strip()
-            id_set.add(i)
+            if i and (sample_filter is None or sample_filter.keeps(i)):
+                id_set[i] = None
     return "\t".join(list(id_set))
 
-def load_case_lists_files(file_list):
-    case_data = list()
-    for f in file_list:
-        data = yaml.safe_load(open(f, 'r'))
-        case_data.append(data)
-    return case_data
-
-def get_values(data_list):
-    d = dict()
-    for data in data_list:
-        for key in data:
-            if key not in d:
-                d[key] = set()
-            d[key].add(data[key])
-    return d
+# Reads the "key: value" lines of a case list file; the key ends at the first ':' and the
+# value may be separated from it by spaces or tabs
+@profiling.profiled_reader('case_list')
+def read_case_list_file(fname):
+    data = dict()
+    with compression.open_text(fname, background=False) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            data[key.strip()] = value.strip()
+    return data
@@ -1,8 +1,19 @@
 import sys
+import functools
+import shutil
+import numpy as np
 import pandas as pd
-import pkgutil
-from ruamel import yaml
-from itertools import islice
+from pandas.api.types import infer_dtype
+
+import common.parallel as parallel
+import common.parse_cache as parse_cache
+import common.profiling as profiling
+import common.dtypes as dtypes
+import common.header_schema as header_schema
+import common.sample_subset as sample_subset
+import common.compression as compression
+import common.clinical_definitions as clinical_definitions
+from common.dedup_index import HashedKeyIndex, hash_rows
 
 # Expects clinical data files to have first four lines to have # as first char (required by cbioportal)
 # But the FIFTH line contains the actual header values
@@ -15,28 +26,34 @@ ROW_DATATYPE = 2
 ROW_PRIORITY = 3
 
 COL_SAMPLES_ORDER = ["SAMPLE_ID", "PATIENT_ID"]
+MUTATIONS_CHUNKSIZE = 100000
+MUTATIONS_FILL_VALUE = "" # written for the columns a MAF-like file does not have
+CLINICAL_WRITE_BLOCKSIZE = 100000
+CNA_BLOCKSIZE = 2000
+# columns holding the sample of a row in MAF-like files: mutations and fusions, then SV
+MUTATIONS_SAMPLE_COLS = ["Tumor_Sample_Barcode", "Sample_Id"]
 DATA_MUTATIONS_UNIQ_COLS = ["Chromosome","Start_Position","End_Position","Reference_Allele","Tumor_Seq_Allele2","Tumor_Sample_Barcode"]
-DEFINITIONS_CLINICAL = yaml.safe_load(pkgutil.get_data('cbioportal_merge', 'resources/clinical_data/data.yaml'))
 COL_PATIENT = ["PATIENT_ID","SEX"]
-COL_SAMPLE = [col for col in DEFINITIONS_CLINICAL.keys() if col != "SEX"]
 
-def run_merge(file_list, additional_df=None):
-    clinical_attrs_by_file = get_clinical_attrs(file_list)
+# Merges clinical files and writes the portal header and data rows into out
+# Returns the merged sample table so later stages do not have to parse the output again.
+# sample_filter applies to the SAMPLE_ID of the rows read from file_list, and in
+# run_merge_patient to their PATIENT_ID
+def run_merge(file_list, out, additional_df=None, schema=None, sample_filter=None):
+    clinical_attrs_by_file = get_clinical_attrs(file_list, schema)
     clin_attrs = get_union_attrs(clinical_attrs_by_file)
-    combined_df = combine_files(file_list, additional_df=additional_df)
-    header = create_portal_header(clin_attrs, combined_df)
-    data = create_data_rows(combined_df)
-    output_string = header + data
-    return output_string
-
-def run_merge_patient(file_list, additional_df=None):
-    clinical_attrs_by_file = get_clinical_attrs(file_list)
+    combined_df = combine_files(file_list, additional_df=additional_df, sample_filter=sample_filter)
+    out.write(create_portal_header(clin_attrs, combined_df))
+    create_data_rows(combined_df, out)
+    return combined_df
+
+def run_merge_patient(file_list, out, additional_df=None, schema=None, sample_filter=None):
+    clinical_attrs_by_file = get_clinical_attrs(file_list, schema)
     clin_attrs = get_union_attrs(clinical_attrs_by_file)
-    combined_df = combine_files_patient(file_list, additional_df=additional_df)
-    header = create_portal_header(clin_attrs, combined_df)
-    data = create_data_rows(combined_df)
-    output_string = header + data
-    return output_string
+    combined_df = combine_files_patient(file_list, additional_df=additional_df, sample_filter=sample_filter)
+    out.write(create_portal_header(clin_attrs, combined_df))
+    create_data_rows(combined_df, out)
+    return combined_df
 
 def create_portal_header(clin_attrs, df):
     header_order = df.columns
@@ -57,48 +74,68 @@ def create_portal_header(clin_attrs, df):
     header += "#" + "\t".join(priority) + "\n"
     return header
 
-def create_data_rows(df):
-    s = "\t".join(df.columns.values.tolist()) + "\n"# just adding the header from the dataframe
-    data = df.values.tolist()
-    for i in data:
-        val = map(str, i)
-        s += "\t".join(val) + "\n"
-    return s
+# Writes the column header and data rows of df into out, a block of rows at a time.
+# Each column is formatted in one pass and rows are joined with str.join over the block,
+# rather than growing one string per row; values are rendered with str() as before.
+def create_data_rows(df, out, blocksize=CLINICAL_WRITE_BLOCKSIZE):
+    out.write("\t".join(df.columns.values.tolist()) + "\n")# just adding the header from the dataframe
+    for start in range(0, len(df), blocksize):
+        block = df.iloc[start:start + blocksize]
+        cols = [format_column(block.iloc[:, i]) for i in range(block.shape[1])]
+        out.write("\n".join(map("\t".join, zip(*cols))) + "\n")
+
+# Columns holding only strings are passed through; anything else goes through str().
+# Categoricals are formatted once per category.
+def format_column(col):
+    if isinstance(col.dtype, pd.CategoricalDtype) and not col.hasnans:
+        categories = np.array(format_column(col.cat.categories.to_series()), dtype=object)
+        return categories[col.cat.codes.to_numpy()].tolist()
+    values = col.tolist()
+    if col.dtype == object and infer_dtype(values, skipna=False) == "string":
+        return values
+    return list(map(str, values))
 
 def get_value(val):
     if isinstance(val, int):
         return str(val)
     return val
 
-def combine_files(file_list, additional_df=pd.DataFrame()):
-    dfs = list()
-    for fname in file_list:
-        df = pd.read_csv(fname, index_col = None, sep="\t", header = 0, comment = '#', keep_default_na=False, converters={'PROJECT_ID': lambda x: str(x), 'REQUEST_ID': lambda x: str(x)})
-        df.fillna('', inplace=True)
-        dfs.append(df)
+def combine_files(file_list, additional_df=pd.DataFrame(), sample_filter=None):
+    dfs = parallel.map_files(functools.partial(read_clinical_sample_file, sample_filter=sample_filter), file_list)
     if not additional_df.empty:
         dfs.append(additional_df)
     return pd.concat(dfs,ignore_index=True).drop_duplicates(subset='SAMPLE_ID').reset_index(drop=True)
 
-def combine_files_patient(file_list, additional_df=pd.DataFrame()):
-    dfs = list()
-    for fname in file_list:
-        df = pd.read_csv(fname, index_col = None, sep="\t", header = 0, comment = '#', keep_default_na=False)
-        df.fillna('', inplace=True)
-        dfs.append(df)
+@profiling.profiled_reader('clinical_sample')
+@parse_cache.cached_frame('clinical_sample')
+def read_clinical_sample_file(fname, sample_filter=None):
+    with sample_subset.open_filtered(fname, 'SAMPLE_ID', sample_filter) as f:
+        df = pd.read_csv(f, index_col = None, sep="\t", header = 0, comment = '#', dtype=str, keep_default_na=False)
+    return dtypes.apply_clinical_dtypes(df)
+
+def combine_files_patient(file_list, additional_df=pd.DataFrame(), sample_filter=None):
+    dfs = parallel.map_files(functools.partial(read_clinical_file, sample_filter=sample_filter), file_list)
     if not additional_df.empty:
         dfs.append(additional_df)
     return pd.concat(dfs,ignore_index=True).drop_duplicates(subset='PATIENT_ID').reset_index(drop=True)
 
-def read_sample_data_clinical(file_list):
+@profiling.profiled_reader('clinical')
+@parse_cache.cached_frame('clinical')
+def read_clinical_file(fname, sample_filter=None):
+    with sample_subset.open_filtered(fname, 'PATIENT_ID', sample_filter) as f:
+        df = pd.read_csv(f, index_col = None, sep="\t", header = 0, comment = '#', dtype=str, keep_default_na=False)
+    return dtypes.apply_clinical_dtypes(df)
+
+# Sample data clinical files hold sample and patient attributes, one row per sample;
+# sample_filter drops rows by SAMPLE_ID, and with them the patients left without a sample
+def read_sample_data_clinical(file_list, sample_filter=None):
     sample_dfs = list()
     patient_dfs = list()
     dedup_sample_df = None
     dedup_patient_df = None
-    for fname in file_list:
-        sample_data_df = pd.read_csv(fname, index_col = None, sep="\t", header = 0, comment = '#', keep_default_na=False)
-        sample_data_df.fillna('', inplace=True)
-        sample_df = pd.DataFrame(sample_data_df, columns=[col for col in sample_data_df if col in  COL_SAMPLE])
+    for sample_data_df in parallel.map_files(functools.partial(read_clinical_sample_file, sample_filter=sample_filter), file_list):
+        col_sample = [col for col in clinical_definitions.get_definitions() if col != "SEX"]
+        sample_df = pd.DataFrame(sample_data_df, columns=[col for col in sample_data_df if col in  col_sample])
         patient_df = pd.DataFrame(sample_data_df, columns=[col for col in sample_data_df if col in  COL_PATIENT])
         sample_dfs.append(sample_df)
         patient_dfs.append(patient_df)
@@ -123,17 +160,18 @@ def get_union_attrs(clinical_attrs_by_file):
         for key in clin_attrs:
             if key not in union_attrs:
                 union_attrs[key] = clin_attrs[key]
-    union_attrs = override_attr(union_attrs, DEFINITIONS_CLINICAL)
-    check_attr(union_attrs, DEFINITIONS_CLINICAL)
+    definitions = clinical_definitions.get_definitions()
+    union_attrs = override_attr(union_attrs, definitions)
+    check_attr(union_attrs, definitions)
     return union_attrs
 
-# Gets the attributes from clinical data files.
-def get_clinical_attrs(file_list):
-    # get expected header attributes from YAML files
+# Gets the attributes from the headers of clinical data files.
+def get_clinical_attrs(file_list, schema=None):
+    if schema is None:
+        schema = header_schema.scan(file_list)
     clinical_attrs = dict()
     for clin_file in file_list:
-        attrs = get_attr(clin_file)
-        clinical_attrs[clin_file] = attrs
+        clinical_attrs[clin_file] = get_attr(clin_file, schema)
     return clinical_attrs
 
 def override_attr(attrs, attr_override):
@@ -154,9 +192,11 @@ def check_attr(attrs, expected_attrs):
                     print("\tActual Key %s, attribute %s, actual value %s" % (key, attr, actual))
                     sys.exit(1)
 
-def get_attr(clin_file):
-    with open(clin_file, 'r') as f:
-        data = list(islice(f, 5))
+def get_attr(clin_file, schema):
+    # the four attribute rows, followed by the column line
+    data = schema.get_comments(clin_file)[:ROW_HEADER]
+    data = data + [""] * (ROW_HEADER - len(data))
+    data.append("\t".join(schema.get_columns(clin_file)))
     headers = data[ROW_HEADER].strip().split("\t")
     attrs = compile_attrs(headers, data)
     return attrs
@@ -185,62 +225,218 @@ def format_string(s):
         s = s[1:]
     return str(s)
 
-# We are asuming file_list will always be non-empty
-def return_only_header(file_list):
-    header = ""
-    f = file_list.pop()
-    data = pd.read_csv(f, sep="\t", header = 0, comment = '#', index_col = 0, keep_default_na=False)
-    return "\t".join(data.columns) + "\n"
+# Merges CNA matrices (genes x samples) into out without holding a Python string per
+# cell: each file is parsed into a matrix of small integer codes into its table of
+# distinct values, so discrete CNA costs one byte per cell and the original text of each
+# value is written back unchanged. Files are aligned once against the union of all gene
+# indexes; genes missing from a file get the sentinel code -1, which every table maps to
+# the fill value. Rows are then rendered and written out a block of genes at a time.
+# Files whose header has no sample columns (or none kept by sample_filter) are not parsed at all.
+# Returns the sample columns written after Hugo_Symbol
+def merge_cna_fusions(file_list, out, fillna=False, blocksize=CNA_BLOCKSIZE, schema=None, sample_filter=None):
+    if schema is None:
+        schema = header_schema.scan(file_list)
+    if sample_filter is None:
+        file_list = [fname for fname in file_list if schema.get_samples(fname)]
+    else:
+        file_list = [fname for fname in file_list if sample_filter.select(schema.get_samples(fname))]
+    read_cna = functools.partial(read_cna_file, sample_filter=sample_filter)
+    cnas = [cna for cna in parallel.map_files(read_cna, file_list) if cna['samples'] and cna['genes']]
+    if not cnas:
+        print("No CNA files to concatenate")
+        return []
+    genes = get_union_index([cna['genes'] for cna in cnas])
+    fill_value = "NA" if fillna else ""
+    header = ['Hugo_Symbol']
+    codes = list()
+    tables = list()
+    for cna in cnas:
+        codes.append(align_codes(cna, genes))
+        tables.append(np.array(cna['table'] + [fill_value], dtype=object))
+        header.extend(cna['samples'])
+    out.write("\t".join(header) + "\n")
+    gene_names = genes.to_numpy(dtype=object)
+    for start in range(0, len(gene_names), blocksize):
+        stop = start + blocksize
+        block = [gene_names[start:stop, None]] + [table[code[start:stop]] for table, code in zip(tables, codes)]
+        out.write("\n".join(map("\t".join, np.hstack(block).tolist())) + "\n")
+    return header[1:]
 
-def merge_cna_fusions(file_list, fillna=False):
-    dfs = list()
-    try:
-        for fname in file_list:
-            df = pd.read_csv(fname, sep="\t", header = 0, comment = '#', index_col = 0, keep_default_na=False)
-            if not df.empty:
-                dfs.append(df) 
-        main_df = pd.concat(dfs, axis=1, sort=False)
-        if fillna:
-            main_df = main_df.fillna("NA")
-        main_df.index.name = 'Hugo_Symbol'
-        s = main_df.to_csv(sep='\t')
-    except ValueError:
-        s = ""
-        print("No fusion files to concatenate")
-    return s
-
-def merge_mutations(file_list, fillna=False, deduplicate=False):
-    dfs = list()
-    try:
-        for fname in file_list:
-            df = pd.read_csv(fname, sep="\t", header = 0, comment = '#', index_col = 0, keep_default_na=False)
-            df.reset_index()
-            if not df.empty:
-                dfs.append(df) 
-        main_df = pd.concat(dfs, sort=False)
-        if fillna:
-            main_df = main_df.fillna("NA")
-        if deduplicate:
-            main_df.drop_duplicates(subset=DATA_MUTATIONS_UNIQ_COLS)
-        s = main_df.to_csv(sep='\t')
-    except ValueError:
-        s = return_only_header(file_list)
-        print("No mutation files to concatenate; returning only header")
-    return s
-
-# Need to get header for files so that they can be merged
-def get_columns_from_files(file_list):
-    columns = set()
+# Parses a genes x samples file into codes (int matrix) indexing table (distinct values).
+# With sample_filter, only the columns of kept samples are parsed.
+@profiling.profiled_reader('cna')
+@parse_cache.cached_arrays('cna')
+def read_cna_file(fname, chunksize=CNA_BLOCKSIZE, sample_filter=None):
+    table = dict()
+    genes = list()
+    blocks = list()
+    columns = header_schema.read_file_header(fname)['columns']
+    samples = columns[1:]
+    usecols = None
+    if sample_filter is not None:
+        usecols = [0] + [i for i in range(1, len(columns)) if sample_filter.keeps(columns[i])]
+        samples = [columns[i] for i in usecols[1:]]
+    with compression.open_text(fname) as f:
+        reader = pd.read_csv(f, sep="\t", header = 0, comment = '#', index_col = 0, usecols=usecols, dtype=str, keep_default_na=False, chunksize=chunksize)
+        for chunk in reader:
+            codes, uniques = pd.factorize(chunk.to_numpy().ravel())
+            remap = np.array([table.setdefault(value, len(table)) for value in uniques], dtype=np.int32)
+            blocks.append(remap[codes].reshape(chunk.shape))
+            genes.extend(chunk.index)
+    if blocks:
+        codes = np.concatenate(blocks).astype(np.min_scalar_type(-len(table) - 1))
+    else:
+        codes = np.zeros((0, len(samples)), dtype=np.int8)
+    duplicated = pd.Index(genes, dtype=object).duplicated(keep='first')
+    if duplicated.any():
+        print("Duplicate genes found in %s; keeping the first row of each" % fname)
+        genes = [gene for gene, dup in zip(genes, duplicated) if not dup]
+        codes = codes[~duplicated]
+    return {'genes': genes, 'samples': samples, 'codes': codes, 'table': list(table)}
+
+# Rows of the file's codes in union gene order; genes the file lacks get -1
+def align_codes(cna, genes):
+    pos = pd.Index(cna['genes'], dtype=object).get_indexer(genes)
+    codes = cna['codes'][pos]
+    codes[pos == -1] = -1
+    return codes
+
+# Genes of the first file followed by those first seen in each later file
+def get_union_index(gene_lists):
+    genes = dict()
+    for gene_list in gene_lists:
+        for gene in gene_list:
+            genes[gene] = None
+    return pd.Index(list(genes), dtype=object)
+
+# Streams MAF-like files (mutations, fusions, sv) into out one chunk at a time.
+# The output header is the union of the input headers, taken from schema (or scanned from
+# the header lines only), so memory is bounded by chunksize regardless of the number of files merged.
+# Each chunk is written under that header by column name (see write_remapped); columns its
+# file does not have are written as fill_value.
+#
+# With deduplicate, rows sharing DATA_MUTATIONS_UNIQ_COLS are dropped through a hashed key
+# index; keep='first' lets the earliest copy win and is built while streaming, keep='last'
+# needs a prior pass over the key columns only. Returns the number of rows written and removed.
+#
+# base_file is a previous merged output that the rows of file_list are appended to. The
+# sample of each row (see MUTATIONS_SAMPLE_COLS) is checked against sample_filter as rows
+# are read, and recorded in sample_ids, in first-seen order, when it is a dict.
+def merge_mutations(file_list, out, fill_value=MUTATIONS_FILL_VALUE, deduplicate=False, keep='first', chunksize=MUTATIONS_CHUNKSIZE, base_file=None, sample_ids=None, schema=None, sample_filter=None):
+    stats = {'rows': 0, 'duplicates_removed': 0}
+    if schema is None:
+        schema = header_schema.scan(file_list)
+    columns = schema.get_union_columns(file_list)
+    # An existing merged output is copied through as-is when the new rows fit its columns;
+    # otherwise it is merged like any other input
+    append = False
+    if base_file is not None:
+        base_columns = schema.get_columns(base_file)
+        if base_columns and set(columns).issubset(base_columns) and not (deduplicate and keep == 'last'):
+            columns = base_columns
+            append = True
+        else:
+            file_list = [base_file] + list(file_list)
+            columns = schema.get_union_columns(file_list)
+    if not columns:
+        print("No mutation files to concatenate")
+        return stats
+    if deduplicate and not set(DATA_MUTATIONS_UNIQ_COLS).issubset(columns):
+        print("Mutation files are missing key columns %s; skipping deduplication" % ",".join(DATA_MUTATIONS_UNIQ_COLS))
+        deduplicate = False
+    if deduplicate and keep == 'last':
+        hashes = [h for fname in file_list for h in read_key_hashes(fname, fill_value, chunksize, sample_filter)]
+        keep_mask = get_keep_last_mask(hashes)
+    index = HashedKeyIndex()
+    offset = 0
+    if append:
+        with compression.open_text(base_file) as f:
+            shutil.copyfileobj(f, out)
+        sample_col = get_sample_column(base_columns)
+        for chunk in read_key_chunks(base_file, fill_value, chunksize, sample_filter, sample_col):
+            if deduplicate:
+                index.add(hash_rows(chunk, DATA_MUTATIONS_UNIQ_COLS))
+            add_sample_ids(sample_ids, chunk, sample_col)
+            stats['rows'] += len(chunk)
+    else:
+        out.write("\t".join(columns) + "\n")
     for fname in file_list:
-        df = pd.read_csv(fname, index_col = None, sep="\t", header = 0, comment = '#', keep_default_na=False)
-        cols = df.columns.values.tolist()
-        for i in cols:
-            columns.add(i)
-    return columns
-
-def represents_int(s):
-    try: 
-        int(s)
-        return True
-    except ValueError:
-        return False
+        sample_col = get_sample_column(schema.get_columns(fname))
+        for chunk in read_mutation_chunks(fname, chunksize, sample_filter=sample_filter):
+            if deduplicate:
+                if keep == 'last':
+                    mask = keep_mask[offset:offset + len(chunk)]
+                else:
+                    mask = index.add_new(hash_rows(get_key_frame(chunk, fill_value), DATA_MUTATIONS_UNIQ_COLS))
+                offset += len(chunk)
+                stats['duplicates_removed'] += len(chunk) - int(mask.sum())
+                chunk = chunk[mask]
+            add_sample_ids(sample_ids, chunk, sample_col)
+            stats['rows'] += len(chunk)
+            write_remapped(chunk, columns, out, fill_value)
+    return stats
+
+# Writes the rows of chunk under columns: each output column is taken from chunk by name,
+# or is fill_value throughout when chunk's file does not have it, so no frame of the whole
+# output layout is built. A block whose values hold a tab, line break or quote is written
+# with to_csv instead, which quotes them as the merge always has.
+def write_remapped(chunk, columns, out, fill_value):
+    if chunk.empty:
+        return
+    rows = len(chunk)
+    cols = [format_column(chunk[col]) if col in chunk.columns else [fill_value] * rows for col in columns]
+    text = "\n".join(map("\t".join, zip(*cols))) + "\n"
+    if '"' in text or '\r' in text or text.count('\n') != rows or text.count('\t') != rows * (len(columns) - 1):
+        chunk.reindex(columns=columns, fill_value=fill_value).to_csv(out, sep='\t', header=False, index=False)
+    else:
+        out.write(text)
+
+# The key columns of chunk, with those its file does not have filled in
+def get_key_frame(chunk, fill_value):
+    if set(DATA_MUTATIONS_UNIQ_COLS).issubset(chunk.columns):
+        return chunk
+    return chunk.reindex(columns=DATA_MUTATIONS_UNIQ_COLS, fill_value=fill_value)
+
+@profiling.profiled_reader('maf')
+@parse_cache.cached_chunks('maf')
+def read_mutation_chunks(fname, chunksize=MUTATIONS_CHUNKSIZE, sample_filter=None):
+    with sample_subset.open_filtered(fname, MUTATIONS_SAMPLE_COLS, sample_filter) as f:
+        reader = pd.read_csv(f, sep="\t", header = 0, comment = '#', dtype=str, keep_default_na=False, chunksize=chunksize)
+        yield from reader
+
+# Yields the key hashes of each chunk of fname, reading only the key columns
+def read_key_hashes(fname, fill_value, chunksize, sample_filter=None):
+    for chunk in read_key_chunks(fname, fill_value, chunksize, sample_filter):
+        yield hash_rows(chunk, DATA_MUTATIONS_UNIQ_COLS)
+
+# Chunks of the key columns of fname, followed by sample_col when it is not one of them
+@profiling.profiled_reader('maf_keys')
+def read_key_chunks(fname, fill_value, chunksize, sample_filter=None, sample_col=None):
+    columns = list(DATA_MUTATIONS_UNIQ_COLS)
+    if sample_col is not None and sample_col not in columns:
+        columns.append(sample_col)
+    key_cols = set(columns)
+    with sample_subset.open_filtered(fname, MUTATIONS_SAMPLE_COLS, sample_filter) as f:
+        reader = pd.read_csv(f, sep="\t", header = 0, comment = '#', dtype=str, keep_default_na=False, chunksize=chunksize, usecols=lambda col: col in key_cols)
+        for chunk in reader:
+            yield chunk.reindex(columns=columns, fill_value=fill_value)
+
+# The column holding the sample of each row among columns, or None
+def get_sample_column(columns):
+    for col in MUTATIONS_SAMPLE_COLS:
+        if col in columns:
+            return col
+    return None
+
+def add_sample_ids(sample_ids, chunk, sample_col):
+    if sample_ids is None or sample_col is None:
+        return
+    for sample_id in chunk[sample_col].unique():
+        if sample_id:
+            sample_ids[sample_id] = None
+
+# Marks the last copy of each key across the hashes of every row, in file order
+def get_keep_last_mask(hashes):
+    if not hashes:
+        return np.zeros(0, dtype=bool)
+    return ~pd.Series(np.concatenate(hashes)).duplicated(keep='last').to_numpy()
@@ -0,0 +1,36 @@
+import os
+import json
+import pkgutil
+
+# Definitions (display name, description, datatype, priority) of the clinical attributes
+# that take precedence over the headers of the input files. resources/clinical_data/data.yaml
+# is the source; the merge loads its compiled copy, data.json, which needs no YAML parser
+# and loads in a fraction of the time. Recompile after editing data.yaml:
+#   python -m common.clinical_definitions
+# benchmark/startup.py checks that the two agree.
+
+SOURCE_FILE = 'resources/clinical_data/data.yaml'
+COMPILED_FILE = 'resources/clinical_data/data.json'
+
+_definitions = None
+
+# Loaded on first use rather than when the merge modules are imported
+def get_definitions():
+    global _definitions
+    if _definitions is None:
+        _definitions = json.loads(pkgutil.get_data('cbioportal_merge', COMPILED_FILE))
+    return _definitions
+
+def read_source():
+    from ruamel import yaml
+    return yaml.safe_load(pkgutil.get_data('cbioportal_merge', SOURCE_FILE))
+
+def compile_definitions():
+    fpath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), COMPILED_FILE)
+    with open(fpath, 'w') as f:
+        json.dump(read_source(), f, indent=1)
+        f.write('\n')
+    print("Wrote %s" % fpath)
+
+if __name__ == "__main__":
+    compile_definitions()
@@ -1,26 +1,26 @@
 import sys
-import pandas as pd
-import pkgutil
-from ruamel import yaml
 from itertools import islice
 
+import common.clinical_data_merge as clin_data_merge
+import common.meta_files as meta_files
 from lib.oncotree_data_handler.OncotreeDataHandler import OncotreeDataHandler
 
-def make_meta_clinical(study_id, datatype):
+# suffix is the compression suffix of the data files, if any
+def make_meta_clinical(study_id, datatype, suffix=""):
     s = "cancer_study_identifier: %s\n" % study_id
     s += "genetic_alteration_type: CLINICAL\n"
     s += "datatype: %s\n" % datatype
     if datatype == "SAMPLE_ATTRIBUTES":
-        s += "data_filename: data_clinical_sample.txt"+ '\n'
+        s += "data_filename: data_clinical_sample.txt" + suffix + '\n'
         return s
-    s += "data_filename: data_clinical_patient.txt" + '\n'
+    s += "data_filename: data_clinical_patient.txt" + suffix + '\n'
     return s
 
 # Since CNA, fusions, and mutations_extended are assumed stable, this returns a dictionary
 #   with what's supposed to be written into each respective file.
 #
-# The keys of the dictionary are the output file names
-def make_meta_info(study_id):
+# The keys of the dictionary are the output file names; suffix is appended to each data_filename
+def make_meta_info(study_id, suffix=""):
     meta_vars = dict()
     meta_vars['meta_CNA.txt'] = { 'study_id': study_id,
             'fname': 'data_CNA.txt',
@@ -67,6 +67,8 @@ def make_meta_info(study_id):
             'show': 'false',
             'stable_id': 'mutations_uncalled' }
     
+    for key in meta_vars:
+        meta_vars[key]['fname'] += suffix
     data = make_meta_files(meta_vars)
     return data
 
@@ -86,11 +88,12 @@ def make_meta_files(meta_vars):
         results[key] = s
     return results
 
-# params keys: study_id, title, clin_sample_file, desc
+# params keys: study_id, title, clin_sample_df, desc
 # Should clean this up later but this is only for meta_study.txt
+# Returns the meta_study.txt contents and the Oncotree diagnostics from get_onco_code
 def get_meta_study(file_list, params):
-    data = load_meta_files(file_list)
-    merged_meta = get_values(data)
+    data = meta_files.load_meta(file_list)
+    merged_meta = meta_files.get_values(data)
     # overwrite with params values
     if params['title'] is not None:
         merged_meta['name'] = params['title']
@@ -110,39 +113,28 @@ def get_meta_study(file_list, params):
     merged_meta['groups'] = ";".join(list(merged_meta['groups']))
 
     # write output string
-    df = pd.read_csv(params['clin_sample_file'], comment="#", sep="\t", keep_default_na=False, converters={'PROJECT_ID': lambda x: str(x)})
-    df.fillna('', inplace=True)
-    cancer_type = get_onco_code(df)
+    cancer_type, oncotree_diagnostics = get_onco_code(params['clin_sample_df'])
     s = "cancer_study_identifier: %s\n" % merged_meta['cancer_study_identifier']
     s += "description: %s\n" % merged_meta['description'] 
     s += "name: %s\n" % merged_meta['name']
     s += "groups: %s\n" % merged_meta['groups']
     s += "short_name: %s\n" % merged_meta['short_name']
     s += "type_of_cancer: %s\n" % cancer_type
-    return s
-
-def get_values(data_list):
-    d = dict()
-    for data in data_list:
-        for key in data:
-            if key not in d:
-                d[key] = set()
-            d[key].add(data[key])
-    return d
-
-def load_meta_files(file_list):
-    meta_data = list()
-    for f in file_list:
-        data = yaml.safe_load(open(f, 'r'))
-        meta_data.append(data)
-    return meta_data
+    return s, oncotree_diagnostics
 
+# Returns the lowest common ancestor of the ONCOTREE_CODE column of the merged sample
+#   table and its diagnostics
 def get_onco_code(df):
     oncotree_dh = OncotreeDataHandler()
-    code_list = df['ONCOTREE_CODE'].values.tolist()
-
-    shared_nodes = oncotree_dh.find_shared_nodes_by_code_list(code_list)
-    common_anc = oncotree_dh.get_highest_level_shared_node(shared_nodes)
+    # count the codes as they are written to data_clinical_sample.txt
+    codes = clin_data_merge.format_column(df['ONCOTREE_CODE'])
+    code_counts = dict()
+    for code in codes:
+        code_counts[code] = code_counts.get(code, 0) + 1
+
+    common_anc, diagnostics = oncotree_dh.get_lowest_common_ancestor(code_counts)
+    for code, count in diagnostics['unknown_codes'].items():
+        print("Oncotree code '%s' does not exist; %i samples defaulted to TISSUE" % (code, count))
     if common_anc.code.lower() == "tissue":
-        return 'mixed'
-    return common_anc.code.lower()
+        return 'mixed', diagnostics
+    return common_anc.code.lower(), diagnostics
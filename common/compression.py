@@ -0,0 +1,179 @@
+import io
+import os
+import sys
+import gzip
+import zlib
+import queue
+import threading
+
+import common.parallel as parallel
+
+# Transparent gzip and zstd support for inputs and outputs. An input may be stored with a
+# COMPRESSED_SUFFIXES suffix under any of the names runner looks for; outputs are compressed
+# when a codec is given. zstd needs the zstandard package, which is only imported when a
+# .zst file is read or written.
+#
+# Codecs run on a background thread: a reader decompresses ahead of the parser into a
+# bounded queue of blocks, and a writer compresses the blocks the merge has written while
+# it goes on parsing. zlib and zstandard release the GIL while they work, and zstd output
+# is compressed by up to --jobs threads.
+
+COMPRESSED_SUFFIXES = {'.gz': 'gz', '.zst': 'zst'}
+CODEC_SUFFIXES = {'gz': '.gz', 'zst': '.zst'}
+BLOCK_SIZE = 1 << 20 # bytes handed between the codec thread and the merge at a time
+QUEUE_BLOCKS = 8 # blocks buffered ahead of the reader, or behind the writer
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+def get_codec(fpath):
+    return COMPRESSED_SUFFIXES.get(os.path.splitext(fpath)[1])
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        print("Reading or writing .zst files needs the zstandard package (pip install zstandard)")
+        sys.exit(1)
+    return zstandard
+
+# Opens a plain or compressed input as text. Without background, a compressed file is
+# decompressed as it is read, for callers reading only its first lines.
+def open_text(fpath, background=True):
+    codec = get_codec(fpath)
+    if codec is None:
+        return open(fpath, 'r')
+    if codec == 'gz':
+        stream = gzip.open(fpath, 'rb')
+    else:
+        stream = import_zstandard().ZstdDecompressor().stream_reader(open(fpath, 'rb'), read_across_frames=True)
+    if background:
+        stream = io.BufferedReader(BackgroundReader(stream), BLOCK_SIZE)
+    return io.TextIOWrapper(stream)
+
+# Opens fpath for writing text, compressed with codec unless it is None
+def open_output(fpath, codec=None):
+    if codec is None:
+        return open(fpath, 'w')
+    return BackgroundWriter(open(fpath, 'wb'), get_compressor(codec))
+
+def get_compressor(codec):
+    if codec == 'gz':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    threads = parallel.JOBS if parallel.JOBS > 1 else 0
+    return import_zstandard().ZstdCompressor(level=ZSTD_LEVEL, threads=threads).compressobj()
+
+# Binary stream of the blocks a thread reads ahead from a decompressing stream
+class BackgroundReader(io.RawIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+        self.blocks = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.block = memoryview(b"")
+        self.done = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped:
+                block = self.stream.read(BLOCK_SIZE)
+                self.blocks.put(block)
+                if not block:
+                    return
+        except BaseException as e:
+            self.blocks.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.block and not self.done:
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            self.done = not block
+            self.block = memoryview(block)
+        size = min(len(b), len(self.block))
+        b[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            # unblock the thread if it is waiting for room in the queue
+            self.stopped = True
+            while self.thread.is_alive():
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.stream.close()
+        super().close()
+
+# Text output whose blocks are encoded and compressed into raw by a thread
+class BackgroundWriter:
+    def __init__(self, raw, compressor):
+        self.raw = raw
+        self.compressor = compressor
+        self.pending = list()
+        self.pending_size = 0
+        self.blocks = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.raw.write(self.compressor.compress(block.encode('utf-8')))
+            except BaseException as e:
+                self.error = e
+        if self.error is None:
+            try:
+                self.raw.write(self.compressor.flush())
+            except BaseException as e:
+                self.error = e
+
+    def write(self, s):
+        self.pending.append(s)
+        self.pending_size += len(s)
+        if self.pending_size >= BLOCK_SIZE:
+            self.submit()
+        return len(s)
+
+    def submit(self):
+        if self.error is not None:
+            raise self.error
+        if self.pending:
+            self.blocks.put("".join(self.pending))
+            self.pending = list()
+            self.pending_size = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.submit()
+        finally:
+            self.blocks.put(None)
+            self.thread.join()
+            self.raw.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+# Set of row keys kept as sorted runs of 64 bit hashes, so each key costs 8 bytes and
+# tens of millions of MAF rows can be indexed without holding the rows themselves.
+# Runs are merged like a binary counter, keeping O(log n) runs to search per lookup.
+# Two different keys sharing a hash is possible but vanishingly rare (~n^2 / 2^65).
+class HashedKeyIndex:
+    def __init__(self):
+        self.runs = list()
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            pos = np.searchsorted(run, hashes)
+            pos[pos == len(run)] = 0
+            found |= run[pos] == hashes
+        return found
+
+    def add(self, hashes):
+        if len(hashes) == 0:
+            return
+        run = np.unique(hashes)
+        while self.runs and len(self.runs[-1]) <= len(run):
+            run = np.union1d(self.runs.pop(), run)
+        self.runs.append(run)
+
+    # Returns a mask of the hashes seen for the first time and adds them to the index
+    def add_new(self, hashes):
+        new = ~pd.Series(hashes).duplicated(keep='first').to_numpy()
+        new &= ~self.contains(hashes)
+        self.add(hashes[new])
+        return new
+
+def hash_rows(df, key_cols):
+    return pd.util.hash_pandas_object(df[key_cols], index=False).to_numpy()
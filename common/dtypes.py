@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+# Compact dtypes for parsed clinical tables, which stay in memory for the whole merge and
+# are kept by the parse caches. MAF-like chunks are streamed to the output one at a time,
+# so they stay text: typing them costs more parse time than their memory is worth.
+# Files are always read as text, and a column is only given a narrower dtype when writing
+# it back reproduces the original text exactly:
+#   - integers when every value is an integer in canonical form ("12", not "012" or "+12")
+#   - floats when every value is what str() of the parsed float gives back ("0.5", not "0.50")
+#   - categoricals for columns with few distinct values
+# Empty and NA values are text like any other, so a column holding them stays as it is (or
+# becomes a categorical), and the merged output is byte-identical to the untyped merge.
+#
+# Conversion works on the distinct values of a column, so repeated values cost one lookup.
+
+# a clinical column becomes a categorical when it has at most this share of distinct values
+CATEGORY_MAX_RATIO = 0.5
+
+# Clinical attributes have no fixed schema, so every column is tried as an integer, then
+# a float, then a categorical
+def apply_clinical_dtypes(df):
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        codes, uniques = pd.factorize(df[col].to_numpy())
+        converted = convert_uniques(uniques, int)
+        if converted is None:
+            converted = convert_uniques(uniques, float)
+        if converted is not None:
+            df[col] = pd.Series(converted[codes], index=df.index)
+        elif len(uniques) <= CATEGORY_MAX_RATIO * len(df):
+            df[col] = pd.Categorical.from_codes(codes, uniques)
+    return df
+
+# Returns uniques parsed with parse, or None when any value is not text that str() of its
+# parsed value gives back exactly
+def convert_uniques(uniques, parse):
+    dtype = np.int64 if parse is int else np.float64
+    try:
+        values = [parse(value) for value in uniques]
+        converted = np.array(values, dtype=dtype)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    for value, text in zip(converted.tolist(), uniques):
+        if str(value) != text:
+            return None
+    if parse is float and np.isnan(converted).any():
+        return None
+    return converted
@@ -0,0 +1,69 @@
+import common.parallel as parallel
+import common.profiling as profiling
+import common.compression as compression
+
+# Header-only view of the inputs of a merge. Every input file is read once up to its column
+# line, before any data is parsed, and the merge stages take what they need from here:
+#   - the '#' lines above the columns (the attribute rows of clinical files)
+#   - the columns of each file, and their union over the files of a data type
+#   - the sample IDs of genes x samples files (CNA), which are their columns after the first
+# A file that was not part of the scan (e.g. the previous output of an incremental merge) is
+# read the first time it is asked for. Each header read is profiled as a 'header' read of the
+# bytes up to the column line.
+
+class Schema:
+    def __init__(self):
+        self.headers = dict()
+
+    def add(self, file_list):
+        missing = [fname for fname in dict.fromkeys(file_list) if fname not in self.headers]
+        for fname, header in zip(missing, parallel.map_files(read_file_header, missing)):
+            self.headers[fname] = header
+
+    def get_header(self, fname):
+        if fname not in self.headers:
+            self.headers[fname] = read_file_header(fname)
+        return self.headers[fname]
+
+    def get_comments(self, fname):
+        return self.get_header(fname)['comments']
+
+    def get_columns(self, fname):
+        return self.get_header(fname)['columns']
+
+    # Ordered union of the columns found across the headers of file_list
+    def get_union_columns(self, file_list):
+        columns = dict()
+        for fname in file_list:
+            for col in self.get_columns(fname):
+                columns[col] = None
+        return list(columns)
+
+    def get_samples(self, fname):
+        return self.get_columns(fname)[1:]
+
+# Reads the headers of every file in file_list concurrently
+def scan(file_list):
+    schema = Schema()
+    schema.add(file_list)
+    return schema
+
+# Bytes of text read and rows parsed (none) for the profile of read_file_header
+def measure_header(header):
+    return header['bytes_read'], 0
+
+# The '#' lines up to the first column line of a tab-delimited file, and its columns;
+# blank lines are skipped and nothing past the column line is read
+@profiling.profiled_reader('header', measure=measure_header)
+def read_file_header(fname):
+    comments = list()
+    bytes_read = 0
+    with compression.open_text(fname, background=False) as f:
+        for line in f:
+            bytes_read += len(line.encode('utf-8'))
+            line = line.rstrip('\r\n')
+            if line.startswith('#'):
+                comments.append(line)
+            elif line.strip():
+                return {'comments': comments, 'columns': line.split('\t'), 'bytes_read': bytes_read}
+    return {'comments': comments, 'columns': list(), 'bytes_read': bytes_read}
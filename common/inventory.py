@@ -0,0 +1,124 @@
+import os
+import sys
+import fnmatch
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import common.compression as compression
+
+# Discovery of the input files of a merge. Each directory, and each subdirectory named by
+# the files looked for (case_lists/), is listed once with os.scandir and the names are
+# matched in memory, rather than checking every name and compressed suffix with its own
+# exists call. On NFS or Lustre every one of those calls is a metadata round trip, so the
+# directories are also listed concurrently, on more threads than --jobs since the work is
+# bound by the filesystem's latency rather than by CPU.
+#
+# The size and mtime of every file found are kept in an Inventory. While a merge runs its
+# inventory is registered, and stat_file answers from it: the manifest, the parse cache
+# keys and the stage scheduling in runner use these sizes and mtimes instead of stat'ing
+# the inputs again. A file no registered inventory holds is stat'ed as before.
+
+SCAN_THREADS = 16
+
+InputFile = namedtuple('InputFile', ['path', 'size', 'mtime_ns'])
+
+_registered = dict() # path -> InputFile, from the inventories of the merges running
+_registered_lock = threading.Lock()
+
+class Inventory:
+    def __init__(self):
+        self.files_by_dir = dict()
+
+    # Maps each file name (or glob) found in directory to its path
+    def get_paths(self, directory):
+        return dict((name, found.path) for name, found in self.files_by_dir[directory].items())
+
+    def get_files(self):
+        for found in self.files_by_dir.values():
+            for input_file in found.values():
+                yield input_file
+
+    # Total size of the files in file_list, stat'ing those the inventory does not hold
+    def get_size(self, file_list):
+        return sum(stat_file(fpath)[0] for fpath in file_list if fpath)
+
+# Finds names (paths relative to the directory) and glob patterns in every directory
+def scan(directories, names, patterns, threads=SCAN_THREADS):
+    directories = list(dict.fromkeys(directories))
+    inventory = Inventory()
+    if len(directories) < 2:
+        results = [scan_directory(directory, names, patterns) for directory in directories]
+    else:
+        with ThreadPoolExecutor(max_workers=min(threads, len(directories))) as pool:
+            results = list(pool.map(lambda directory: scan_directory(directory, names, patterns), directories))
+    for directory, found in zip(directories, results):
+        inventory.files_by_dir[directory] = found
+    return inventory
+
+# Maps each name and pattern found in directory to its InputFile. A name may be stored with
+# a compressed suffix (see common/compression.py); the plain file is taken first, then the
+# suffixes in COMPRESSED_SUFFIXES order. A pattern matching several files is an error.
+def scan_directory(directory, names, patterns):
+    suffixes = [''] + list(compression.COMPRESSED_SUFFIXES)
+    wanted = dict()
+    for name in names:
+        subdir, base = os.path.split(name)
+        wanted.setdefault(subdir, list()).append((base, name))
+    if patterns:
+        wanted.setdefault('', list())
+    listings = dict((subdir, list_files(os.path.join(directory, subdir))) for subdir in wanted)
+    found = dict()
+    for subdir in wanted:
+        entries = listings[subdir]
+        for base, name in wanted[subdir]:
+            for suffix in suffixes:
+                if base + suffix in entries:
+                    found[name] = get_input_file(entries[base + suffix])
+                    break
+    entries = listings.get('', dict())
+    for pattern in patterns:
+        # like glob, '*' does not match hidden files (e.g. atomic_open's temporary files)
+        for suffix in suffixes:
+            result = sorted(entries[fname].path for fname in entries
+                if not fname.startswith('.') and fnmatch.fnmatchcase(fname, pattern + suffix))
+            if result:
+                break
+        if len(result) > 1:
+            print("Found multiple files when there should only be one: %s" % ";".join(result))
+            sys.exit(1)
+        if result:
+            found[pattern] = get_input_file(entries[os.path.basename(result[0])])
+    return found
+
+# The files (not subdirectories) of path by name; empty if path is not a directory
+def list_files(path):
+    try:
+        with os.scandir(path) as it:
+            return dict((entry.name, entry) for entry in it if entry.is_file())
+    except (FileNotFoundError, NotADirectoryError):
+        return dict()
+
+def get_input_file(entry):
+    st = entry.stat()
+    return InputFile(entry.path, st.st_size, st.st_mtime_ns)
+
+# Makes the sizes and mtimes of inventory's files answer stat_file while a merge runs
+def register(inventory):
+    with _registered_lock:
+        for input_file in inventory.get_files():
+            _registered[input_file.path] = input_file
+
+def unregister(inventory):
+    with _registered_lock:
+        for input_file in inventory.get_files():
+            if _registered.get(input_file.path) is input_file:
+                del _registered[input_file.path]
+
+# (size, mtime_ns) of fpath, from a registered inventory when it holds the file
+def stat_file(fpath):
+    input_file = _registered.get(fpath)
+    if input_file is not None:
+        return input_file.size, input_file.mtime_ns
+    st = os.stat(fpath)
+    return st.st_size, st.st_mtime_ns
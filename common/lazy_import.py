@@ -0,0 +1,17 @@
+import importlib
+
+# Modules that pull in pandas, numpy or ruamel take most of the startup time of the command
+# line tools, and are not needed for --help or for checking arguments. Entry points import
+# them as LazyModule, which imports the module the first time one of its attributes is
+# used. importlib's per-module import lock makes the first use safe from any thread.
+
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(module, attr)
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+
+import common.inventory as inventory
+from common.atomic_writer import atomic_open
+
+# Record of the inputs that produced a merged output directory, used by --incremental_from
+# to merge in only the project directories that were added since.
+#
+# Every input file is described by path, size and mtime. Its sha256 is added when it is
+# already known (from the previous manifest when size and mtime match, or because the
+# parse cache hashed the file in this run), and files are only hashed for the manifest
+# in incremental mode, so a plain merge does not read every input a second time. A file
+# whose size and mtime match the previous manifest is unchanged; one whose size or mtime
+# differ is compared by hash when the previous manifest has one, and is changed otherwise.
+# Checking a large unchanged directory thus costs a stat per file, and nothing for the
+# files of a registered inventory (see common/inventory.py).
+
+MANIFEST_FILE = ".aion_manifest.json"
+HASH_BLOCKSIZE = 1 << 20
+
+# Digests already computed in this process, by path, size and mtime, so that the parse
+# cache and the manifest hash each input only once per run
+_digests = dict()
+
+def file_digest(fpath):
+    size, mtime_ns = inventory.stat_file(fpath)
+    key = (fpath, size, mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(fpath, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCKSIZE), b''):
+                h.update(block)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+# The digest of fpath if this process already computed it, else None
+def known_digest(fpath):
+    size, mtime_ns = inventory.stat_file(fpath)
+    return _digests.get((fpath, size, mtime_ns))
+
+def is_same_stat(desc, previous):
+    return previous is not None and previous['size'] == desc['size'] and previous['mtime'] == desc['mtime']
+
+def describe_file(fpath, previous=None, hash_file=False):
+    size, mtime_ns = inventory.stat_file(fpath)
+    desc = {'size': size, 'mtime': mtime_ns}
+    if is_same_stat(desc, previous) and 'sha256' in previous:
+        desc['sha256'] = previous['sha256']
+    elif hash_file:
+        desc['sha256'] = file_digest(fpath)
+    else:
+        digest = known_digest(fpath)
+        if digest is not None:
+            desc['sha256'] = digest
+    return desc
+
+def describe_files(fpaths, previous_files=None, hash_files=False):
+    previous_files = previous_files or dict()
+    files = dict()
+    for fpath in fpaths:
+        files[fpath] = describe_file(fpath, previous_files.get(fpath), hash_files)
+    return files
+
+# files_by_dir maps each input directory to the paths merged from it; with hash_files,
+# every file is described with its sha256
+def build_manifest(options, files_by_dir, sample_data_clinical_files, previous=None, hash_files=False):
+    previous = previous or {'directories': dict(), 'sample_data_clinical_files': dict()}
+    directories = dict()
+    for directory in files_by_dir:
+        directories[directory] = describe_files(files_by_dir[directory], previous['directories'].get(directory), hash_files)
+    sample_files = describe_files(sample_data_clinical_files, previous['sample_data_clinical_files'], hash_files)
+    return {'options': options, 'directories': directories, 'sample_data_clinical_files': sample_files}
+
+def load_manifest(output_dir):
+    fpath = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(fpath):
+        return None
+    with open(fpath, 'r') as f:
+        return json.load(f)
+
+def write_manifest(output_dir, manifest):
+    with atomic_open(os.path.join(output_dir, MANIFEST_FILE)) as o:
+        json.dump(manifest, o, indent=1)
+
+def is_unchanged(previous_files, fpaths):
+    if set(previous_files) != set(fpaths):
+        return False
+    for fpath in fpaths:
+        previous = previous_files[fpath]
+        size, mtime_ns = inventory.stat_file(fpath)
+        if is_same_stat({'size': size, 'mtime': mtime_ns}, previous):
+            continue
+        if 'sha256' not in previous or file_digest(fpath) != previous['sha256']:
+            return False
+    return True
+
+# Splits the current directories into new ones and ones that differ from the manifest;
+# directories listed in the manifest but no longer given are returned as removed
+def compare_manifest(previous, files_by_dir):
+    previous_dirs = previous['directories']
+    new_dirs = list()
+    changed_dirs = list()
+    for directory in files_by_dir:
+        if directory not in previous_dirs:
+            new_dirs.append(directory)
+        elif not is_unchanged(previous_dirs[directory], files_by_dir[directory]):
+            changed_dirs.append(directory)
+    removed_dirs = [directory for directory in previous_dirs if directory not in files_by_dir]
+    return new_dirs, changed_dirs, removed_dirs
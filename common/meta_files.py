@@ -0,0 +1,23 @@
+import common.compression as compression
+
+# Reading of the key: value meta files (and case lists) merged by the study stages
+
+def load_meta(file_list):
+    # ruamel is slow to import and only needed once meta files are read
+    from ruamel import yaml
+    meta_data = list()
+    for f in file_list:
+        with compression.open_text(f, background=False) as meta_file:
+            data = yaml.safe_load(meta_file)
+        meta_data.append(data)
+    return meta_data
+
+# Collects the distinct values of every key, in the order they are first seen
+def get_values(data_list):
+    d = dict()
+    for data in data_list:
+        for key in data:
+            if key not in d:
+                d[key] = dict()
+            d[key][data[key]] = None
+    return d
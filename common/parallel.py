@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import common.profiling as profiling
+
+# Worker pools used by --jobs. Threads are used rather than processes: read_csv releases
+# the GIL while tokenizing, and parsed frames would otherwise be pickled between processes.
+#
+# Whole merges (one per output file) run on a stage pool created by runner, while the
+# per-file reads inside a merge share a separate read pool. Read tasks never wait on other
+# tasks, so a stage blocked on its reads cannot deadlock the pools.
+
+JOBS = 1
+_read_pool = None
+_read_pool_lock = threading.Lock()
+
+def set_jobs(jobs):
+    global JOBS, _read_pool
+    jobs = max(1, int(jobs or 1))
+    if jobs != JOBS and _read_pool is not None:
+        _read_pool.shutdown()
+        _read_pool = None
+    JOBS = jobs
+
+def stage_pool():
+    return ThreadPoolExecutor(max_workers=JOBS)
+
+# Applies func to every file, returning results in file_list order whatever the --jobs setting
+def map_files(func, file_list):
+    global _read_pool
+    file_list = list(file_list)
+    func = profiling.bind(func)
+    if JOBS == 1 or len(file_list) < 2:
+        return [func(fname) for fname in file_list]
+    # several studies may be merged at once (batch_merge.py), so the pool is created under a lock
+    with _read_pool_lock:
+        if _read_pool is None:
+            _read_pool = ThreadPoolExecutor(max_workers=JOBS)
+        read_pool = _read_pool
+    return list(read_pool.map(func, file_list))
+
+def get_results(futures):
+    results = dict()
+    for key in futures:
+        results[key] = futures[key].result()
+    return results
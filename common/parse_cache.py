@@ -0,0 +1,337 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+import common.manifest as manifest
+import common.inventory as inventory
+
+# Content-addressed, on-disk cache of parsed input files, shared by every study merged
+# with the same --cache_dir. Entries are keyed by the sha256 of the file together with the
+# reader that parsed it, so the same project file merged into another study is not parsed
+# again, while an edited file never hits.
+#
+# Data frames are stored as a stream of pickled chunks (pandas keeps their columns as
+# numpy blocks, so loading is several times faster than parsing the text again); the CNA
+# code matrices are stored as .npy files and memory-mapped on load. Hits refresh an
+# entry's mtime. The cache keeps a running total of the size of its entries, and once a
+# new entry takes it past the size limit, the least recently used entries are evicted
+# down to EVICT_TARGET_RATIO of the limit, so the directory is only listed again after
+# a good share of the cache has been rewritten.
+#
+# Loading a pickle can run arbitrary code, so anyone able to write to the cache could run
+# code in the merges that use it. The cache directory must therefore be private: it is
+# created with mode 0700, and a directory not owned by the current user or open to other
+# users is refused.
+#
+# Cached readers take an optional sample_filter (see common/sample_subset.py); what a file
+# parses to under a filter is cached apart from its unfiltered parse.
+#
+# Bump CACHE_VERSION whenever a cached reader changes what it returns.
+#
+# Merges of several studies in one process (batch_merge.py) also share a MemoryCache: the
+# clinical frames and CNA arrays each file parses to are kept in memory and handed to every
+# study that reads the file, so callers must not modify what a cached reader returns. It
+# is bounded by the same size limit as the on-disk cache, evicting the least recently used
+# results. Chunk streams (MAF-like and seg files) are only shared through the on-disk cache.
+# A batch without a --cache_dir limits its temporary on-disk cache to the files read by
+# more than one of its studies (see cache_only): writing out a file only one study reads
+# costs more than it saves.
+
+CACHE_VERSION = 3
+FRAMES_FILE = "frames.pkl"
+META_FILE = "meta.json"
+EVICT_TARGET_RATIO = 0.9
+
+CACHE = None
+MEMORY = None
+CACHED_FILES = None # absolute paths of the only files CACHE keeps, or None for every file
+
+def configure(cache_dir, max_bytes):
+    global CACHE
+    CACHE = ParseCache(cache_dir, max_bytes) if cache_dir else None
+
+# Limits the on-disk cache to the files of paths; None caches every file again
+def cache_only(paths):
+    global CACHED_FILES
+    CACHED_FILES = None if paths is None else set(os.path.abspath(fpath) for fpath in paths)
+
+# The on-disk cache fpath goes through, or None
+def get_cache(fpath):
+    if CACHED_FILES is not None and os.path.abspath(fpath) not in CACHED_FILES:
+        return None
+    return CACHE
+
+def share_in_memory(enabled, max_bytes):
+    global MEMORY
+    MEMORY = MemoryCache(max_bytes) if enabled else None
+
+# Parsed results keyed by file and reader, in least recently used order. A file being
+# parsed by one thread is waited on, not parsed again, by any other thread asking for it.
+class MemoryCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.sizes = dict() # sizes of the results parsed so far
+        self.total_bytes = 0
+
+    def get(self, fpath, reader_name, read_func):
+        size, mtime_ns = inventory.stat_file(fpath)
+        key = (os.path.abspath(fpath), size, mtime_ns, reader_name)
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+            if owner:
+                future = self.results[key] = Future()
+            else:
+                self.results.move_to_end(key)
+        if owner:
+            try:
+                result = read_func(fpath)
+            except BaseException as e:
+                future.set_exception(e)
+                with self.lock:
+                    self.results.pop(key, None)
+                raise
+            future.set_result(result)
+            self.add_size(key, get_result_size(result))
+        return future.result()
+
+    # Counts a parsed result and evicts the least recently used results (never one still
+    # being parsed) while the cache holds more than max_bytes. Threads already holding an
+    # evicted result keep using it.
+    def add_size(self, key, size):
+        with self.lock:
+            if key not in self.results:
+                return
+            self.sizes[key] = size
+            self.total_bytes += size
+            for old_key in list(self.results):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if old_key in self.sizes:
+                    del self.results[old_key]
+                    self.total_bytes -= self.sizes.pop(old_key)
+
+# Bytes held by a cached result: a data frame, or a dict of numpy arrays and small values
+def get_result_size(result):
+    if hasattr(result, 'memory_usage'):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    return sum(value.nbytes for value in result.values() if isinstance(value, np.ndarray))
+
+class ParseCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pending = dict() # entries being written by a thread of this process
+        self.total_bytes = 0
+        check_private_dir(cache_dir)
+        self.evict(self.max_bytes)
+
+    def entry_path(self, fpath, reader_name):
+        key = "%s:%s:%i" % (manifest.file_digest(fpath), reader_name, CACHE_VERSION)
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    def lookup(self, entry):
+        if not os.path.isdir(entry):
+            return False
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        return True
+
+    # Returns None when the calling thread is now the one writing entry, or an event set
+    # once the thread already writing it is done
+    def claim(self, entry):
+        with self.lock:
+            if entry in self.pending:
+                return self.pending[entry]
+            self.pending[entry] = threading.Event()
+            return None
+
+    def release(self, entry):
+        with self.lock:
+            self.pending.pop(entry).set()
+
+    def new_entry(self, entry):
+        tmp_entry = "%s.%i.%i.tmp" % (entry, os.getpid(), threading.get_ident())
+        os.makedirs(tmp_entry, exist_ok=True)
+        return tmp_entry
+
+    # Publishes a fully written entry; another process may have published it first
+    def commit(self, tmp_entry, entry):
+        size = get_entry_size(tmp_entry)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        with self.lock:
+            self.total_bytes += size
+            over_limit = self.total_bytes > self.max_bytes
+        if over_limit:
+            self.evict(int(self.max_bytes * EVICT_TARGET_RATIO))
+
+    # Lists the whole cache, including entries other processes wrote, and removes the least
+    # recently used entries until it holds at most target_bytes
+    def evict(self, target_bytes):
+        with self.lock:
+            entries = list()
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.endswith(".tmp") or not os.path.isdir(path):
+                    continue
+                try:
+                    size = get_entry_size(path)
+                    entries.append((os.path.getmtime(path), size, path))
+                except FileNotFoundError:
+                    continue
+                total += size
+            for mtime, size, path in sorted(entries):
+                if total <= target_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+            self.total_bytes = total
+
+def get_entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+# Creates cache_dir readable by the current user only, or exits if an existing one is
+# owned by another user or open to other users
+def check_private_dir(cache_dir):
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    st = os.stat(cache_dir)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print("Cache directory %s must be owned by the current user and not accessible to others (chmod 700)" % cache_dir)
+        sys.exit(1)
+
+def get_reader_key(reader_name, sample_filter):
+    if sample_filter is None:
+        return reader_name
+    return "%s:%s" % (reader_name, sample_filter.digest)
+
+# Caches a reader returning one data frame
+def cached_frame(reader_name):
+    def decorator(read_func):
+        @functools.wraps(read_func)
+        def wrapper(fpath, sample_filter=None):
+            reader_key = get_reader_key(reader_name, sample_filter)
+            def read_frame(f):
+                return list(read_chunks(reader_key, lambda f: [read_func(f, sample_filter=sample_filter)], f))[0]
+            if MEMORY is not None:
+                return MEMORY.get(fpath, reader_key, read_frame)
+            return read_frame(fpath)
+        return wrapper
+    return decorator
+
+# Caches a reader yielding a file as a sequence of data frame chunks
+def cached_chunks(reader_name):
+    def decorator(read_func):
+        @functools.wraps(read_func)
+        def wrapper(fpath, *args, sample_filter=None, **kwargs):
+            reader_key = get_reader_key(reader_name, sample_filter)
+            return read_chunks(reader_key, lambda f: read_func(f, *args, sample_filter=sample_filter, **kwargs), fpath)
+        return wrapper
+    return decorator
+
+def read_chunks(reader_name, read_func, fpath):
+    cache = get_cache(fpath)
+    if cache is None:
+        yield from read_func(fpath)
+        return
+    entry = cache.entry_path(fpath, reader_name)
+    while True:
+        if cache.lookup(entry):
+            try:
+                f = open(os.path.join(entry, FRAMES_FILE), 'rb')
+            except FileNotFoundError:
+                f = None
+            if f is not None:
+                with f:
+                    while True:
+                        try:
+                            yield pickle.load(f)
+                        except EOFError:
+                            return
+        # another study of this process is parsing the file; wait for its entry
+        writing = cache.claim(entry)
+        if writing is None:
+            break
+        writing.wait()
+    try:
+        tmp_entry = cache.new_entry(entry)
+        try:
+            with open(os.path.join(tmp_entry, FRAMES_FILE), 'wb') as f:
+                for chunk in read_func(fpath):
+                    pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield chunk
+        except BaseException:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        cache.commit(tmp_entry, entry)
+    finally:
+        cache.release(entry)
+
+# Caches a reader returning a dict of numpy arrays and JSON-serializable values
+def cached_arrays(reader_name):
+    def decorator(read_func):
+        @functools.wraps(read_func)
+        def wrapper(fpath, sample_filter=None):
+            reader_key = get_reader_key(reader_name, sample_filter)
+            def read(f):
+                return read_arrays(f, reader_key, sample_filter)
+            if MEMORY is not None:
+                return MEMORY.get(fpath, reader_key, read)
+            return read(fpath)
+        def read_arrays(fpath, reader_key, sample_filter):
+            cache = get_cache(fpath)
+            if cache is None:
+                return read_func(fpath, sample_filter=sample_filter)
+            entry = cache.entry_path(fpath, reader_key)
+            if cache.lookup(entry):
+                try:
+                    return load_arrays(entry)
+                except FileNotFoundError:
+                    pass
+            data = read_func(fpath, sample_filter=sample_filter)
+            tmp_entry = cache.new_entry(entry)
+            try:
+                save_arrays(tmp_entry, data)
+            except BaseException:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                raise
+            cache.commit(tmp_entry, entry)
+            return data
+        return wrapper
+    return decorator
+
+def save_arrays(entry, data):
+    meta = dict()
+    for key in data:
+        if isinstance(data[key], np.ndarray):
+            np.save(os.path.join(entry, key + ".npy"), data[key])
+        else:
+            meta[key] = data[key]
+    with open(os.path.join(entry, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+def load_arrays(entry):
+    with open(os.path.join(entry, META_FILE), 'r') as f:
+        data = json.load(f)
+    for fname in os.listdir(entry):
+        if fname.endswith(".npy"):
+            data[fname[:-len(".npy")]] = np.load(os.path.join(entry, fname), mmap_mode='r')
+    return data
@@ -0,0 +1,217 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Instrumentation behind --profile. Every stage of a merge (one per output file, plus the
+# steps runner takes on its own) records its wall time, the CPU time of the thread running
+# it, the growth of the process's peak RSS, the rows read and the lines and bytes written.
+# Every input file read records the same for its reader, and is counted in the stage that
+# asked for it, including reads done on the shared read pool.
+#
+# While PROFILER is None, stage() hands back a shared no-op context and profiled_reader and
+# bind return their arguments' results untouched, so an unprofiled merge only pays for one
+# global lookup per stage and per file.
+
+PROFILER = None
+_current = threading.local()
+
+def enable():
+    global PROFILER
+    PROFILER = Profiler()
+
+def disable():
+    global PROFILER
+    PROFILER = None
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.stages = list()
+        self.files = list()
+
+    def add(self, records, record):
+        with self.lock:
+            records.append(record)
+
+    def get_report(self):
+        return {
+            'wall_seconds': time.perf_counter() - self.start,
+            'cpu_seconds': time.process_time() - self.cpu_start,
+            'max_rss_kb': get_max_rss_kb(),
+            'stages': self.stages,
+            'files': self.files,
+        }
+
+    # Chrome trace event format, viewable in chrome://tracing or Perfetto
+    def get_trace(self):
+        events = list()
+        for category, records in [('stage', self.stages), ('file', self.files)]:
+            for record in records:
+                args = dict((key, value) for key, value in record.items() if key not in ('name', 'start', 'thread'))
+                events.append({'name': record['name'], 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                    'tid': record['thread'], 'ts': record['start'] * 1e6, 'dur': record['wall_seconds'] * 1e6, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+class _NoStage:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+def stage(name):
+    if PROFILER is None:
+        return _NO_STAGE
+    return _stage(PROFILER, name)
+
+@contextmanager
+def _stage(profiler, name):
+    record = {'name': name, 'thread': threading.get_ident(), 'start': time.perf_counter() - profiler.start,
+        'rows_in': 0, 'bytes_read': 0, 'files_read': 0, 'lines_out': 0, 'bytes_written': 0}
+    parent = getattr(_current, 'stage', None)
+    _current.stage = record
+    cpu_start = time.thread_time()
+    rss_start = get_max_rss_kb()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - profiler.start - record['start']
+        record['cpu_seconds'] = time.thread_time() - cpu_start
+        record['peak_rss_delta_kb'] = get_max_rss_kb() - rss_start
+        _current.stage = parent
+        profiler.add(profiler.stages, record)
+
+# Runs func inside stage(name); used to submit whole stages to a pool
+def call(name, func, *args, **kwargs):
+    with stage(name):
+        return func(*args, **kwargs)
+
+# Wraps func so that it runs in the caller's stage when called from another thread
+def bind(func):
+    if PROFILER is None:
+        return func
+    record = getattr(_current, 'stage', None)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        parent = getattr(_current, 'stage', None)
+        _current.stage = record
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.stage = parent
+    return wrapper
+
+# Records each file a reader parses. Readers return a data frame, a dict of arrays (rows are
+# its 'genes'), a dict of key/value pairs, or an iterator of data frame chunks; the time of an
+# iterator is the time spent producing its chunks. A reader that only reads part of its file
+# passes measure, which returns the bytes read and rows parsed from its result; otherwise the
+# whole file counts as read.
+def profiled_reader(reader_name, measure=None):
+    def decorator(read_func):
+        @functools.wraps(read_func)
+        def wrapper(fpath, *args, **kwargs):
+            if PROFILER is None:
+                return read_func(fpath, *args, **kwargs)
+            record = start_file(PROFILER, reader_name, fpath)
+            cpu_start = time.thread_time()
+            result = read_func(fpath, *args, **kwargs)
+            if hasattr(result, '__next__'):
+                return profile_chunks(PROFILER, record, result, cpu_start)
+            record['wall_seconds'] = time.perf_counter() - PROFILER.start - record['start']
+            record['cpu_seconds'] = time.thread_time() - cpu_start
+            if measure is None:
+                record['rows'] = count_rows(result)
+            else:
+                record['bytes'], record['rows'] = measure(result)
+            end_file(PROFILER, record)
+            return result
+        return wrapper
+    return decorator
+
+def profile_chunks(profiler, record, chunks, cpu_start):
+    record['wall_seconds'] = time.perf_counter() - profiler.start - record['start']
+    record['cpu_seconds'] = time.thread_time() - cpu_start
+    try:
+        while True:
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                record['wall_seconds'] += time.perf_counter() - start
+                record['cpu_seconds'] += time.thread_time() - cpu_start
+            record['rows'] += len(chunk)
+            yield chunk
+    finally:
+        end_file(profiler, record)
+
+def start_file(profiler, reader_name, fpath):
+    try:
+        size = os.path.getsize(fpath)
+    except OSError:
+        size = 0
+    stage_record = getattr(_current, 'stage', None)
+    return {'name': os.path.basename(fpath), 'path': fpath, 'reader': reader_name, 'bytes': size, 'rows': 0,
+        'stage': stage_record['name'] if stage_record is not None else None,
+        'thread': threading.get_ident(), 'start': time.perf_counter() - profiler.start}
+
+def end_file(profiler, record):
+    stage_record = getattr(_current, 'stage', None)
+    if stage_record is not None:
+        with profiler.lock:
+            stage_record['files_read'] += 1
+            stage_record['bytes_read'] += record['bytes']
+            stage_record['rows_in'] += record['rows']
+    profiler.add(profiler.files, record)
+
+def count_rows(result):
+    if isinstance(result, dict):
+        return len(result['genes']) if 'genes' in result else len(result)
+    try:
+        return len(result)
+    except TypeError:
+        return 0
+
+# Counts the lines and bytes written to out by the current stage
+class CountingWriter:
+    def __init__(self, out, record):
+        self.out = out
+        self.record = record
+
+    def write(self, s):
+        self.record['lines_out'] += s.count('\n')
+        self.record['bytes_written'] += len(s.encode('utf-8'))
+        return self.out.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+# Output handle for the current stage: out itself unless profiling
+def counting(out):
+    record = getattr(_current, 'stage', None)
+    if PROFILER is None or record is None:
+        return out
+    return CountingWriter(out, record)
+
+def get_max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def write_profile(fpath, trace_file=None):
+    if PROFILER is None:
+        return
+    if fpath:
+        with open(fpath, 'w') as f:
+            json.dump(PROFILER.get_report(), f, indent=2)
+    if trace_file:
+        with open(trace_file, 'w') as f:
+            json.dump(PROFILER.get_trace(), f)
@@ -0,0 +1,108 @@
+import hashlib
+
+import common.compression as compression
+
+# Merging a subset of the samples of a set of projects (--include_samples, --exclude_samples).
+# The filter is pushed into every reader rather than applied to the merged output:
+#   - rows of clinical, MAF-like and seg files are dropped from the text before it reaches
+#     read_csv (see FilteredFile), so excluded rows are never parsed
+#   - CNA files only parse the columns of kept samples
+#   - case list ids are dropped as they are split
+# Parsed files are cached apart for every filter (see parse_cache.get_reader_key).
+
+FILTER_READ_SIZE = 1 << 20 # characters of input filtered at a time
+
+class SampleFilter:
+    def __init__(self, include=None, exclude=None):
+        self.include = None if include is None else set(include)
+        self.exclude = set(exclude or [])
+        key = "include:%s\nexclude:%s" % ("\t".join(sorted(self.include)) if include is not None else "",
+            "\t".join(sorted(self.exclude)))
+        self.digest = hashlib.sha256(key.encode()).hexdigest()
+
+    def keeps(self, sample_id):
+        return (self.include is None or sample_id in self.include) and sample_id not in self.exclude
+
+    def select(self, sample_ids):
+        return [sample_id for sample_id in sample_ids if self.keeps(sample_id)]
+
+# The filter given by the ID list files, or None when neither is given
+def load_sample_filter(include_file=None, exclude_file=None):
+    if include_file is None and exclude_file is None:
+        return None
+    include = read_id_file(include_file) if include_file is not None else None
+    exclude = read_id_file(exclude_file) if exclude_file is not None else None
+    return SampleFilter(include, exclude)
+
+# One ID per line; blank and '#' lines are skipped and only the first tab-separated field is used
+def read_id_file(fname):
+    ids = list()
+    with open(fname, 'r') as f:
+        for line in f:
+            sample_id = line.split('\t', 1)[0].strip()
+            if sample_id and not sample_id.startswith('#'):
+                ids.append(sample_id)
+    return ids
+
+# Opens fname for read_csv, holding only the rows whose id_column is kept by sample_filter.
+# id_column is a position, a name, or a list of names of which the first found is used
+def open_filtered(fname, id_column, sample_filter):
+    f = compression.open_text(fname)
+    if sample_filter is None:
+        return f
+    return FilteredFile(f, id_column, sample_filter)
+
+# Read-only text stream over a tab-delimited file that passes through its '#' lines and
+# header line and drops the rows sample_filter does not keep. A file without id_column is
+# passed through whole.
+class FilteredFile:
+    def __init__(self, f, id_column, sample_filter):
+        self.f = f
+        self.sample_filter = sample_filter
+        self.buffer = ""
+        self.index = None
+        for line in f:
+            self.buffer += line
+            if not line.startswith('#') and line.strip():
+                columns = line.rstrip('\r\n').split('\t')
+                if isinstance(id_column, int):
+                    self.index = id_column
+                else:
+                    names = [id_column] if isinstance(id_column, str) else id_column
+                    found = [name for name in names if name in columns]
+                    self.index = columns.index(found[0]) if found else None
+                break
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            lines = self.f.readlines(FILTER_READ_SIZE)
+            if not lines:
+                break
+            self.buffer += "".join(self.filter_lines(lines))
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def filter_lines(self, lines):
+        if self.index is None:
+            return lines
+        index = self.index
+        keeps = self.sample_filter.keeps
+        kept = list()
+        for line in lines:
+            fields = line.rstrip('\r\n').split('\t', index + 1)
+            if len(fields) <= index or line.startswith('#') or keeps(fields[index].strip('"')):
+                kept.append(line)
+        return kept
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -1,19 +1,183 @@
+import os
+import heapq
+import tempfile
 import pandas as pd
-from ruamel import yaml
 
-def load_seg_data(file_list):
-    dfs = list()
+import common.parse_cache as parse_cache
+import common.profiling as profiling
+import common.header_schema as header_schema
+import common.sample_subset as sample_subset
+import common.compression as compression
+import common.meta_files as meta_files
+from common.atomic_writer import atomic_open
+
+SEG_CHUNKSIZE = 100000
+SEG_MERGE_FANIN = 64 # sorted runs merged at once, bounding the number of open files
+CHROMOSOME_ORDER = {'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
+
+# Streams seg files into out one chunk at a time under the union of their columns; values
+# are copied through as text. With sort, rows are ordered by sample, chromosome and start
+# using an external merge sort: each chunk is sorted into a run file in a temporary
+# directory and the runs are merged, so memory stays bounded by chunksize.
+#
+# base_file is a previous merged seg file; when the new files share its columns (and the
+# output is not sorted) their rows are appended to a copy of it instead of re-reading it.
+#
+# When index_file is given, the byte offset and length of every contiguous run of a
+# sample's rows in out is written to it, so a sample's segments can be read with one seek.
+# Offsets are into the text of out, before any compression.
+#
+# Columns are taken from schema, or scanned from the header lines of file_list. Rows whose
+# sample (first column) sample_filter does not keep are dropped as they are read.
+# Returns the samples of the written rows, in first-seen order.
+def load_seg_data(file_list, out, base_file=None, sort=False, index_file=None, chunksize=SEG_CHUNKSIZE, schema=None, sample_filter=None):
+    if schema is None:
+        schema = header_schema.scan(file_list)
+    append = False
+    if base_file is not None:
+        base_columns = schema.get_columns(base_file)
+        append = not sort and all(schema.get_columns(fname) == base_columns for fname in file_list)
+        if not append:
+            file_list = [base_file] + list(file_list)
+    columns = base_columns if append else schema.get_union_columns(file_list)
+    if not columns:
+        print("No seg files to concatenate")
+        return []
+    index = SegIndex()
+    if append:
+        with compression.open_text(base_file) as f:
+            header_seen = False
+            for line in f:
+                out.write(line)
+                if header_seen and not line.startswith('#'):
+                    index.add(line.split('\t', 1)[0], line)
+                else:
+                    header_seen = header_seen or bool(line.strip()) and not line.startswith('#')
+                    index.add(None, line)
+    else:
+        line = "\t".join(columns) + "\n"
+        out.write(line)
+        index.add(None, line)
+    lines = read_seg_lines(file_list, columns, chunksize, sample_filter)
+    if sort:
+        with tempfile.TemporaryDirectory(prefix="aion_seg_") as tmp_dir:
+            write_lines(sort_lines(lines, tmp_dir, chunksize), out, index)
+    else:
+        write_lines(lines, out, index)
+    if index_file is not None:
+        with atomic_open(index_file) as f:
+            index.write(f)
+    return index.get_samples()
+
+# Yields the lines of every file reindexed to columns, one chunk (list of lines) at a time
+def read_seg_lines(file_list, columns, chunksize, sample_filter=None):
     for fname in file_list:
-        df = pd.read_csv(fname, sep="\t", header = 0, comment = '#', index_col = 0, keep_default_na=False)
-        if not df.empty:
-            dfs.append(df)
-    main_df = pd.concat(dfs, sort=False)
-    s = main_df.to_csv(sep='\t')
-    return s
+        for chunk in read_seg_chunks(fname, chunksize, sample_filter=sample_filter):
+            chunk = chunk.reindex(columns=columns, fill_value='')
+            cols = [chunk.iloc[:, i].tolist() for i in range(chunk.shape[1])]
+            yield [line + "\n" for line in map("\t".join, zip(*cols))]
+
+@profiling.profiled_reader('seg')
+@parse_cache.cached_chunks('seg_chunks')
+def read_seg_chunks(fname, chunksize=SEG_CHUNKSIZE, sample_filter=None):
+    with sample_subset.open_filtered(fname, 0, sample_filter) as f:
+        yield from pd.read_csv(f, sep="\t", header = 0, comment = '#', dtype=str, keep_default_na=False, chunksize=chunksize)
+
+def write_lines(chunks, out, index):
+    for lines in chunks:
+        for line in lines:
+            index.add(line.split('\t', 1)[0], line)
+        out.write("".join(lines))
+
+# Sorts each chunk into a run file, then merges the runs SEG_MERGE_FANIN at a time.
+# Sorting is stable, and ties between runs go to the earlier run, so rows with equal keys
+# keep their input order. Each pass merges consecutive groups of runs into a run that takes
+# their place, so runs stay in input order from pass to pass.
+def sort_lines(chunks, tmp_dir, chunksize):
+    runs = list()
+    for lines in chunks:
+        runs.append(write_run(sorted(lines, key=get_line_key), tmp_dir, len(runs)))
+    count = len(runs)
+    while len(runs) > SEG_MERGE_FANIN:
+        merged_runs = list()
+        for start in range(0, len(runs), SEG_MERGE_FANIN):
+            merged_runs.append(write_run(merge_runs(runs[start:start + SEG_MERGE_FANIN]), tmp_dir, count))
+            count += 1
+        runs = merged_runs
+    merged = merge_runs(runs)
+    block = list()
+    for line in merged:
+        block.append(line)
+        if len(block) == chunksize:
+            yield block
+            block = list()
+    if block:
+        yield block
+
+def write_run(lines, tmp_dir, number):
+    fpath = os.path.join(tmp_dir, "run_%i.txt" % number)
+    with open(fpath, 'w') as f:
+        f.writelines(lines)
+    return fpath
+
+# Yields the lines of the sorted run files in key order, removing each run once consumed
+def merge_runs(runs):
+    files = [open(fpath, 'r') for fpath in runs]
+    try:
+        yield from heapq.merge(*files, key=get_line_key)
+    finally:
+        for f, fpath in zip(files, runs):
+            f.close()
+            os.remove(fpath)
+
+# Orders by sample, then chromosome (1-22, X, Y, M, then any other name), then start
+def get_line_key(line):
+    fields = line.split('\t', 3)
+    fields += [''] * (3 - len(fields))
+    return (fields[0], get_chromosome_key(fields[1]), get_position_key(fields[2]))
+
+def get_chromosome_key(chrom):
+    name = chrom.strip().upper()
+    if name.startswith('CHR'):
+        name = name[3:]
+    if name.isdigit():
+        return (0, int(name), '')
+    if name in CHROMOSOME_ORDER:
+        return (0, CHROMOSOME_ORDER[name], '')
+    return (1, 0, name)
+
+def get_position_key(start):
+    try:
+        return (0, float(start), '')
+    except ValueError:
+        return (1, 0, start)
+
+# Byte ranges of the contiguous runs of each sample's rows in the merged seg file
+class SegIndex:
+    def __init__(self):
+        self.offset = 0
+        self.ranges = list()
+
+    # sample is None for lines that belong to no sample, such as the header
+    def add(self, sample, line):
+        size = len(line.encode('utf-8'))
+        if sample is not None:
+            if self.ranges and self.ranges[-1][0] == sample and self.ranges[-1][1] + self.ranges[-1][2] == self.offset:
+                self.ranges[-1][2] += size
+            else:
+                self.ranges.append([sample, self.offset, size])
+        self.offset += size
+
+    def get_samples(self):
+        return list(dict.fromkeys(sample for sample, offset, length in self.ranges))
+
+    def write(self, out):
+        out.write("ID\toffset\tlength\n")
+        out.write("".join("%s\t%i\t%i\n" % (sample, offset, length) for sample, offset, length in self.ranges))
 
 def create_seg_meta(file_list, study_id, seg_data_file_name):
-    data = load_meta(file_list)
-    meta_data = get_values(data)
+    data = meta_files.load_meta(file_list)
+    meta_data = meta_files.get_values(data)
     keys_to_join = ['datatype', 'description', 'genetic_alteration_type', 'reference_genome_id']
     for key in keys_to_join:
         meta_data[key] = ";".join(meta_data[key])
@@ -24,19 +188,3 @@ def create_seg_meta(file_list, study_id, seg_data_file_name):
     s += 'genetic_alteration_type: %s\n' % meta_data['genetic_alteration_type']
     s += 'reference_genome_id: %s\n' % meta_data['reference_genome_id']
     return s
-
-def load_meta(file_list):
-    meta_data = list()
-    for f in file_list:
-        data = yaml.safe_load(open(f, 'r'))
-        meta_data.append(data)
-    return meta_data
-
-def get_values(data_list):
-    d = dict()
-    for data in data_list:
-        for key in data:
-            if key not in d:
-                d[key] = set()
-            d[key].add(data[key])
-    return d
@@ -0,0 +1,53 @@
+import os
+
+# Consistency checks of a merged study (--validate), run on the sample ids the merge stages
+# collect as they write their outputs rather than by reading the outputs again:
+#   - the samples of MAF-like rows, CNA columns and seg rows are in data_clinical_sample.txt
+#   - the PATIENT_ID of every sample is in data_clinical_patient.txt
+#   - the ids of every case list are in data_clinical_sample.txt
+#   - the data_filename of every meta file names a file of the output directory
+# Each failing check on a file is reported once, with the number of offending ids and the
+# first MAX_REPORTED_IDS of them.
+
+MAX_REPORTED_IDS = 20
+SAMPLE_FILE = "data_clinical_sample.txt"
+PATIENT_FILE = "data_clinical_patient.txt"
+DESCRIPTIONS = {
+    'sample_not_in_clinical': "%(count)i samples of %(file)s are not in " + SAMPLE_FILE,
+    'patient_not_in_clinical': "%(count)i patients of %(file)s are not in " + PATIENT_FILE,
+    'case_list_sample_not_in_clinical': "%(count)i samples of %(file)s are not in " + SAMPLE_FILE,
+    'missing_data_file': "%(file)s names a data file that was not written",
+}
+
+# samples maps each sample id to its patient id; data_sample_ids maps data file names to
+# the samples of their rows or columns; case_lists and meta_files map file names to the
+# text written to them
+def validate(output_dir, samples, patients, data_sample_ids, case_lists, meta_files):
+    violations = list()
+    patients = set(patients)
+    for fname, sample_ids in data_sample_ids.items():
+        add_violation(violations, 'sample_not_in_clinical', fname, [sample_id for sample_id in sample_ids if sample_id not in samples])
+    add_violation(violations, 'patient_not_in_clinical', SAMPLE_FILE, [patient_id for patient_id in dict.fromkeys(samples.values()) if patient_id not in patients])
+    for fname, text in case_lists.items():
+        case_ids = get_value(text, 'case_list_ids').split('\t')
+        add_violation(violations, 'case_list_sample_not_in_clinical', fname, [case_id for case_id in case_ids if case_id and case_id not in samples])
+    for fname, text in meta_files.items():
+        data_filename = get_value(text, 'data_filename')
+        if data_filename and not os.path.isfile(os.path.join(output_dir, data_filename)):
+            add_violation(violations, 'missing_data_file', fname, [data_filename])
+    return {'valid': not violations, 'violations': violations}
+
+def add_violation(violations, check, fname, ids):
+    if ids:
+        violations.append({'check': check, 'file': fname, 'count': len(ids), 'ids': ids[:MAX_REPORTED_IDS]})
+
+# The value of the first "key: value" line of text, or "" when there is none
+def get_value(text, key):
+    for line in text.splitlines():
+        if line.startswith(key + ':'):
+            return line.split(':', 1)[1].strip(' ')
+    return ""
+
+def print_violations(result):
+    for violation in result['violations']:
+        print("Validation: " + DESCRIPTIONS[violation['check']] % violation + " (%s)" % ", ".join(violation['ids']))
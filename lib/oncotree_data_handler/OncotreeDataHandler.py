@@ -1,20 +1,41 @@
+import argparse
+import hashlib
 import json
 import os
 import unicodedata
-import requests
+
+ONCOTREE_DIR = os.path.dirname(os.path.abspath(__file__))
+ONCOTREE_JSON = os.path.join(ONCOTREE_DIR, 'data/oncotree.json')
+# Compact form of ONCOTREE_JSON with every code's ancestor chain precomputed; rebuilt
+# whenever it no longer matches the sha256 of ONCOTREE_JSON
+ONCOTREE_INDEX = os.path.join(ONCOTREE_DIR, 'data/oncotree_index.json')
+ONCOTREE_API = 'http://oncotree.mskcc.org/api/tumorTypes'
+REFRESH_TIMEOUT = 30
 
 class OncotreeDataHandler:
+    # Loads the bundled Oncotree; the network is only used by refresh_oncotree_data
     def __init__(self):
-        self.oncotree = self.fetch_oncotree_data()
+        self.oncotree = self.load_oncotree_index()
+        self.chains = dict() # code as given -> root-first tuple of codes, None if unknown
+
+    def load_oncotree_index(self):
+        with open(ONCOTREE_JSON, 'rb') as f:
+            source_sha256 = hashlib.sha256(f.read()).hexdigest()
+        index = None
+        if os.path.exists(ONCOTREE_INDEX):
+            with open(ONCOTREE_INDEX, 'r') as f:
+                index = json.load(f)
+        if index is None or index['source_sha256'] != source_sha256:
+            with open(ONCOTREE_JSON, 'r') as f:
+                index = build_index(json.load(f), source_sha256)
+            write_index(index)
+        return self.convert_index(index)
 
-    def fetch_oncotree_data(self):
-        oncotree_dir = os.path.dirname(__file__)
-        oncotree_json = os.path.join(oncotree_dir, 'data/oncotree.json')
-        request = requests.get('http://oncotree.mskcc.org/api/tumorTypes').json()
-        if 'error' in request: # load from file if error
-            request = json.load(open(oncotree_json, 'r'))
-        converted_data = self.convert_data_key(request)
-        return converted_data
+    def convert_index(self, index):
+        d = dict()
+        for code, (name, level, parent, ancestors) in index['nodes'].items():
+            d[code] = OncotreeNode({'code': code, 'name': name, 'level': level, 'parent': parent}, ancestors)
+        return d
 
     def convert_data_key(self, data):
        d = dict()
@@ -37,12 +58,10 @@ class OncotreeDataHandler:
 
     def get_parent_list_by_code(self, code, result):
         node = self.find_by_code(code)
-        parent = node.parent
         result.append(node)
-        if parent is not None:
-            return self.get_parent_list_by_code(parent, result)
-        else:
-            return result
+        for ancestor in node.ancestors:
+            result.append(self.oncotree[ancestor])
+        return result
 
     def find_shared_nodes_by_code_list(self, code_list):
         list_of_sets = list()
@@ -62,12 +81,47 @@ class OncotreeDataHandler:
                 node_to_return = node
         return node_to_return
 
+    # Root-first chain of codes ending in the code itself; None for codes not in the tree
+    def get_ancestor_chain(self, code):
+        if code not in self.chains:
+            node = self.oncotree.get(code.upper())
+            if node is None:
+                self.chains[code] = None
+            else:
+                self.chains[code] = tuple(reversed(node.ancestors)) + (node.code,)
+        return self.chains[code]
+
+    # code_counts maps each distinct code to its number of samples. The lowest common
+    # ancestor is the longest prefix shared by the root-first chains of the distinct codes;
+    # unknown codes resolve to TISSUE as in find_by_code
+    def get_lowest_common_ancestor(self, code_counts):
+        unknown_codes = dict()
+        shared = None
+        for code, count in code_counts.items():
+            chain = self.get_ancestor_chain(code)
+            if chain is None:
+                unknown_codes[code] = int(count)
+                chain = self.get_ancestor_chain("TISSUE")
+            if shared is None:
+                shared = chain
+                continue
+            depth = 0
+            while depth < min(len(shared), len(chain)) and shared[depth] == chain[depth]:
+                depth += 1
+            shared = shared[:depth]
+        if not shared:
+            shared = self.get_ancestor_chain("TISSUE")
+        diagnostics = {'unknown_codes': unknown_codes,
+                'samples_defaulted_to_tissue': sum(unknown_codes.values())}
+        return self.oncotree[shared[-1]], diagnostics
+
 class OncotreeNode:
-    def __init__(self, data):
+    def __init__(self, data, ancestors=()):
         self.code = data['code']
         self.name = data['name']
         self.level = data['level']
         self.parent = data['parent']
+        self.ancestors = tuple(ancestors) # codes from the parent up to the root
 
     def __key(self):
         return (self.code, self.name, self.level, self.parent)
@@ -80,3 +134,52 @@ class OncotreeNode:
 
     def __repr__(self):
         return "OncotreeNode(CODE: %s, NAME: %s, LEVEL: %i, PARENT: %s)" % (self.code, self.name, self.level, self.parent)
+
+# Builds {code: [name, level, parent, ancestor codes from the parent up to the root]}
+def build_index(data, source_sha256):
+    parents = dict()
+    nodes = dict()
+    for node in data:
+        parents[node['code']] = node['parent']
+        nodes[node['code']] = [node['name'], node['level'], node['parent'], []]
+    for code in nodes:
+        ancestors = nodes[code][3]
+        parent = parents[code]
+        while parent is not None and parent in parents:
+            ancestors.append(parent)
+            parent = parents[parent]
+    return {'source_sha256': source_sha256, 'nodes': nodes}
+
+# The index is a cache; a read-only install simply rebuilds it in memory on every load
+def write_index(index):
+    tmp_path = "%s.%i.tmp" % (ONCOTREE_INDEX, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, ONCOTREE_INDEX)
+    except OSError:
+        print("Could not write the Oncotree index to %s" % ONCOTREE_INDEX)
+
+# Downloads the current Oncotree into ONCOTREE_JSON and rebuilds the index
+def refresh_oncotree_data(url=ONCOTREE_API, timeout=REFRESH_TIMEOUT):
+    import requests
+    data = requests.get(url, timeout=timeout).json()
+    if not isinstance(data, list) or 'error' in data:
+        raise ValueError("Unexpected response from %s" % url)
+    content = json.dumps(data).encode()
+    with open(ONCOTREE_JSON, 'wb') as f:
+        f.write(content)
+    write_index(build_index(data, hashlib.sha256(content).hexdigest()))
+    print("Refreshed %i Oncotree codes from %s" % (len(data), url))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Oncotree data bundled with aion")
+    parser.add_argument("--refresh", action="store_true", help="Download the current Oncotree and rebuild the bundled index")
+    parser.add_argument("--url", default=ONCOTREE_API, help="Oncotree tumor types API")
+    parser.add_argument("--timeout", type=float, default=REFRESH_TIMEOUT, help="Request timeout in seconds")
+    args = parser.parse_args()
+    if args.refresh:
+        refresh_oncotree_data(args.url, args.timeout)
+    else:
+        handler = OncotreeDataHandler()
+        print("%i Oncotree codes loaded from %s" % (len(handler.oncotree), ONCOTREE_INDEX))